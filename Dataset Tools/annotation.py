@@ -0,0 +1,126 @@
+import os
+import cv2
+import json
+
+from frame_reader import FrameReader, resize_frame
+from async_stages import prefetch
+from landmark_features import devectorize_landmarks, de_normalize_landmarks, draw_selected_landmarks
+from dataset_io import save_json
+
+'''
+Annotation helpers: persistent window labels and background rendering of the window previews
+
+Labels are kept in a sidecar JSON file, one entry per reviewed window:
+    {"window": {...windowing settings...}, "labels": {source: {window start: 0 / 1 / null (discarded)}},
+     "auto": {source: [starts of the windows labelled by the pre-labeler]}, "completed": [sources fully reviewed]}
+The file is rewritten atomically after every answer, so it is also the checkpoint of a run: a crashed or interrupted
+run resumes at the first window with no label of the first source not completed, and the dataset can be
+materialized later from the cached landmarks, without showing a single frame again. The windowing settings are
+stored with the labels since window starts only make sense for the sequence length, overlap and frame rate they
+were made with.
+'''
+
+PREVIEW_QUEUE_SIZE = 1  # windows rendered ahead of the one being reviewed
+
+
+class LabelStore():
+    def __init__(self, labels_path, window_params):
+        self.labels_path = os.path.expanduser(labels_path)
+        self.window_params = window_params
+        self.labels = {}
+        self.auto = {}
+        self.completed = []
+
+        if os.path.exists(self.labels_path):
+            with open(self.labels_path, 'r') as labels_file:
+                stored = json.load(labels_file)
+
+            if stored['window'] != window_params:
+                raise ValueError(f"{labels_path} was made with windows {stored['window']}, not {window_params}")
+            self.labels = stored['labels']
+            self.auto = stored.get('auto', {})
+            self.completed = stored.get('completed', [])
+
+
+    def has(self, source, start):
+        return str(start) in self.labels.get(source, {})
+
+
+    def set(self, source, start, label, auto=False, save=True):
+        '''
+        Record the label of a window, None for a discarded window, and save the store (unless save is False)
+        auto marks the labels given by the pre-labeler, so that they can be reviewed later
+        '''
+        self.labels.setdefault(source, {})[str(start)] = label
+
+        auto_starts = self.auto.setdefault(source, [])
+        if auto and start not in auto_starts:
+            auto_starts.append(start)
+        elif not auto and start in auto_starts:
+            auto_starts.remove(start)
+
+        if save:
+            self.save()
+
+
+    def is_completed(self, source):
+        return source in self.completed
+
+
+    def mark_completed(self, source):
+        '''
+        Record that every window of a source was reviewed (or skipped), a resumed run does not show it again
+        '''
+        if source not in self.completed:
+            self.completed.append(source)
+        self.save()
+
+
+    def items(self, source):
+        '''
+        (window start, label) of every reviewed window of a source, by start
+        '''
+        return sorted((int(start), label) for start, label in self.labels.get(source, {}).items())
+
+
+    def sources(self):
+        return list(self.labels.keys())
+
+
+    def save(self):
+        # Written to a temporary file first, an interrupted session never loses the labels already given
+        save_json({'window': self.window_params, 'labels': self.labels, 'auto': self.auto, 'completed': self.completed}, self.labels_path)
+
+
+
+def render_window(frame_reader, result, start, sequence_length, max_side):
+    frames = []
+    for j in range(start, start + sequence_length):
+        image = frame_reader.read(result['frame_idx'][j])
+        if max_side is not None:
+            image = resize_frame(image, max_side)
+
+        body_landmarks = devectorize_landmarks(result['queue'][j], result['keys'])
+        normalized_bl = de_normalize_landmarks(body_landmarks, [image.shape[1], image.shape[0]])
+        frames.append(draw_selected_landmarks(normalized_bl, image))
+
+    return frames
+
+
+def iter_previews(result, starts, sequence_length, max_side=None):
+    '''
+    Yield (start, rendered frames) of the given windows of a source
+    Windows are decoded and drawn by a background thread, PREVIEW_QUEUE_SIZE windows ahead of the reviewed one
+    '''
+    def render():
+        with FrameReader(result['source'], sequence_length) as frame_reader: # only the frames of the last window are kept in memory
+            for start in starts:
+                yield start, render_window(frame_reader, result, start, sequence_length, max_side)
+
+    return prefetch(render(), PREVIEW_QUEUE_SIZE)
+
+
+def play_window(frames):
+    for out_img in frames:
+        cv2.imshow('', out_img)
+        cv2.waitKey(20)
@@ -0,0 +1,127 @@
+import queue
+import threading
+
+from dataset_io import open_writer
+from instrumentation import timed
+
+'''
+Producer/consumer stages connected by bounded queues
+prefetch runs a producer (e.g. frame decoding) in a background thread, AsyncWriter runs the dataset writer in a
+background thread. Queues are bounded: a producer faster than its consumer blocks instead of filling the memory.
+OpenCV decoding, MediaPipe inference and file writes release the GIL, so the stages really overlap.
+'''
+
+_DONE = object()
+_POLL_TIMEOUT = 0.1
+
+
+def _put(items, item, stop):
+    # Blocking put that gives up when the consumer has stopped
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=_POLL_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def prefetch(iterable, maxsize):
+    '''
+    Yield the items of iterable, produced ahead by a background thread with at most maxsize items waiting
+    Exceptions of the producer are raised in the consumer, stopping the iteration early stops the producer
+    '''
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, (item, None), stop):
+                    return
+            _put(items, (_DONE, None), stop)
+        except BaseException as e:
+            _put(items, (_DONE, e), stop)
+        finally:
+            # Let a generator release its resources in the producer thread
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+
+class AsyncWriter():
+    '''
+    Dataset writer (see dataset_io.open_writer) running in a background thread
+    write() only blocks when maxsize samples are already waiting to be written
+    Samples given as array views are only materialized (converted/copied) by the background thread
+    With a timer (instrumentation.StageTimer) the writes are timed as the serialization stage
+    '''
+    def __init__(self, out_path, maxsize=64, timer=None, schema=None):
+        self.samples = 0
+        self.error = None
+        self.items = queue.Queue(maxsize)
+        self.timer = timer
+
+        self.writer = open_writer(out_path, schema)
+        self.thread = threading.Thread(target=self.consume, daemon=True)
+        self.thread.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def consume(self):
+        while True:
+            item = self.items.get()
+            if item is _DONE:
+                break
+            if self.error is None:
+                try:
+                    with timed(self.timer, 'serialization'):
+                        self.writer.write_sample(*item)
+                except BaseException as e:
+                    self.error = e
+
+
+    def write(self, row):
+        self.write_sample(row[:-1], row[-1])
+
+
+    def write_sample(self, features, label, source=None, subject=None):
+        if self.error is not None:
+            raise self.error
+
+        self.items.put((features, label, source, subject))
+        self.samples += 1
+
+
+    def close(self):
+        if not self.thread.is_alive():
+            return
+
+        self.items.put(_DONE)
+        self.thread.join()
+        self.writer.close()
+
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,300 @@
+import os
+import sys
+import cv2
+import json
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+
+from dataset_io import load_dataset, open_writer, BAR_INDEX
+from dataset_normalizer import DatasetNormalizer, bar_min_max, normalize_bar, out_of_range
+from dataset_merger import merge_datasets
+from frame_reader import iter_sampled_frames
+from landmark_features import sliding_windows
+from instrumentation import peak_rss_mb, save_report
+
+'''
+Benchmarks of the dataset tools
+Usage: python benchmark_suite.py              synthetic suite, runs offline (no dataset needed)
+       python benchmark_suite.py dataset_path  nested-list vs vectorized normalization on a real dataset
+                                               (JSON and .md4fd datasets are both accepted)
+
+The synthetic suite generates seeded videos, landmark streams and datasets at the sizes below and measures, for each
+stage, the best wall time over REPEATS runs, the throughput (frames/s, windows/s or samples/s) and the peak memory
+allocated during one run (tracemalloc, Python and NumPy allocations). Extraction needs MediaPipe and is skipped
+without it; the synthetic videos show a stick figure, so the detector mostly misses and runs on every frame
+(the worst case for inference time).
+Results are printed and saved to report_path, compare reports of two commits to spot regressions.
+'''
+
+REPEATS = 3
+VIDEO_FRAMES = (150, 600)           # decode / extraction
+STREAM_FRAMES = (10000, 100000)     # windowing
+DATASET_SAMPLES = (1000, 5000)      # JSON read / merge / normalize
+SEQUENCE_LENGTH = 90
+SKIP = 15                           # 75 overlapping frames, as in the dataset configs
+MERGE_INPUTS = 4
+
+
+def timeit(fn, repeats):
+    '''
+    Best wall time of repeats calls of fn, and the value returned by the last call
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def legacy_normalize(data):
+    # Nested-list implementation of DatasetNormalizer before vectorization, kept as a reference
+    min_value = float('inf')
+    max_value = float('-inf')
+    for row in data:
+        for vector in row[:-1]:
+            bar = vector[22]
+            if bar < min_value:
+                min_value = bar
+            if bar > max_value:
+                max_value = bar
+
+    for row in data:
+        for vector in row[:-1]:
+            vector[22] = (vector[22] - min_value) / (max_value - min_value)
+
+    for row in data:
+        for vector in row[:-1]:
+            for el in vector:
+                if (el < 0) or (el > 1):
+                    return min_value, max_value, el
+
+    return min_value, max_value, None
+
+
+def vectorized_normalize(features):
+    min_bar, max_bar = bar_min_max(features)
+    normalize_bar(features, min_bar, max_bar)
+
+    return min_bar, max_bar, out_of_range(features)
+
+
+def bench_normalizer(path, repeats=3):
+    '''
+    Compare the nested-list and the vectorized normalization (min/max, rescaling and range check), parsing excluded
+    '''
+    features, labels = load_dataset(path)
+    data = [sample.astype(np.float64).tolist() + [int(label)] for sample, label in zip(features, labels)]
+
+    # Both implementations normalize in place, so every run gets its own copy, made outside of the timing
+    data_copies = [json.loads(json.dumps(data)) for _ in range(repeats)]
+    features_copies = [features.copy() for _ in range(repeats)]
+
+    legacy_time, legacy_result = timeit(lambda: legacy_normalize(data_copies.pop()), repeats)
+    vectorized_time, vectorized_result = timeit(lambda: vectorized_normalize(features_copies.pop()), repeats)
+
+    frames = features.shape[0] * features.shape[1]
+    print(f"Normalizer on {features.shape[0]} samples ({frames} frames)")
+    print(f"  nested lists: {legacy_time*1000:.1f} ms ({frames/legacy_time:.0f} frames/s)")
+    print(f"  vectorized:   {vectorized_time*1000:.1f} ms ({frames/vectorized_time:.0f} frames/s)")
+    print(f"  speedup:      x{legacy_time/vectorized_time:.1f}")
+    print(f"  min/max BAR:  {legacy_result[:2]} vs {vectorized_result[:2]}")
+
+    return {'samples': features.shape[0], 'legacy_s': legacy_time, 'vectorized_s': vectorized_time}
+
+
+
+def measure(fn, repeats=REPEATS):
+    '''
+    Best wall time of fn over repeats runs and peak memory (MB) allocated during one more, traced, run
+    '''
+    seconds, result = timeit(fn, repeats)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return seconds, peak / (1024 * 1024), result
+
+
+def record(results, stage, size, unit, seconds, peak_mb):
+    results.append({'stage': stage, 'size': size, 'unit': unit, 'seconds': seconds, 'rate': size / seconds, 'peak_mb': peak_mb})
+    print(f"  {stage:<24} {size:>8} {unit:<8} {seconds*1000:>9.1f} ms {size/seconds:>12.0f} {unit}/s {peak_mb:>8.1f} MB")
+
+
+
+def synthetic_video(path, frames, size=(640, 480), fps=30):
+    '''
+    Write a video of a stick figure walking and then falling to the floor
+    '''
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+
+    for t in range(frames):
+        fall = min(max((t - frames / 2) / fps, 0), 1) # the fall takes one second, half way through
+        x = int(width * (0.2 + 0.6 * t / frames))
+        head = (x + int(fall * height * 0.35), int(height * (0.2 + 0.55 * fall)))
+        feet = (x, int(height * 0.85))
+
+        image = np.full((height, width, 3), 200, dtype=np.uint8)
+        cv2.line(image, head, feet, (40, 40, 40), 12)
+        cv2.circle(image, head, 25, (40, 40, 40), -1)
+        writer.write(image)
+
+    writer.release()
+
+
+def synthetic_landmarks(frames, rng, miss_rate=0.05):
+    '''
+    Random walk landmark stream of frames x 23 float64 values, landmarks in [0, 1], BAR in [0.5, 3] and missing (NaN)
+    on miss_rate of the frames
+    '''
+    features = np.clip(0.5 + np.cumsum(rng.normal(0, 0.005, (frames, 23)), axis=0), 0, 1)
+    features[:, BAR_INDEX] = 0.5 + 2.5 * features[:, BAR_INDEX]
+    features[rng.random(frames) < miss_rate, BAR_INDEX] = np.nan
+
+    return features
+
+
+def synthetic_dataset(path, samples, rng, frames=SEQUENCE_LENGTH, batch_size=1000):
+    with open_writer(path) as writer:
+        for start in range(0, samples, batch_size):
+            n = min(batch_size, samples - start)
+            features = rng.random((n, frames, 23), dtype=np.float32)
+            features[:, :, BAR_INDEX] = 0.5 + 50 * features[:, :, BAR_INDEX] # some BAR values need the > 40 repair
+            writer.write_batch(features, rng.integers(0, 2, n))
+
+
+
+def bench_decode(results, video_path, frames):
+    def decode():
+        for idx, image, repeats in iter_sampled_frames(video_path, target_fps=30, max_side=640):
+            pass
+
+    seconds, peak_mb, _ = measure(decode)
+    record(results, 'decode', frames, 'frames', seconds, peak_mb)
+
+
+def bench_extraction(results, video_path, frames):
+    try:
+        from landmark_extractor import LandmarkExtractor
+        from parallel_extractor import extract_source
+    except ImportError as e:
+        print(f"  extraction skipped: {e}")
+        return
+
+    for model in ('holistic', 'pose'):
+        decode_params = {'target_fps': 30, 'max_side': 640}
+
+        # The model is loaded once, outside the timed runs, extract_source resets the tracking state of every run
+        landmark_extractor = LandmarkExtractor(model=model)
+        seconds, peak_mb, result = measure(lambda: extract_source(landmark_extractor, video_path, decode_params), 1)
+        record(results, f'extraction ({model})', frames, 'frames', seconds, peak_mb)
+
+
+def bench_windowing(results, frames, rng):
+    features = synthetic_landmarks(frames, rng)
+    queue = [[None if np.isnan(value) else value for value in vector] for vector in features.tolist()]
+
+    def list_windows():
+        # Windowing loop of the processors before strided views
+        data = []
+        for i in range(0, len(queue) - SEQUENCE_LENGTH + 1, SKIP):
+            row = []
+            for j in range(SEQUENCE_LENGTH):
+                row.append(queue[i + j])
+            row.append(0)
+            data.append(row)
+        return len(data)
+
+    def strided_windows():
+        windows = sliding_windows(features, SEQUENCE_LENGTH, SKIP)
+        for window in windows:
+            window[-1, BAR_INDEX]
+        return len(windows)
+
+    seconds, peak_mb, windows = measure(list_windows)
+    record(results, 'windowing (lists)', windows, 'windows', seconds, peak_mb)
+    seconds, peak_mb, windows = measure(strided_windows)
+    record(results, 'windowing (strided)', windows, 'windows', seconds, peak_mb)
+
+
+def bench_json_read(results, tmp_directory, samples, rng):
+    json_path = os.path.join(tmp_directory, "dataset.json")
+    synthetic_dataset(json_path, samples, rng)
+
+    def json_load():
+        # JSON reading of the merger and normalizer before the block reader
+        with open(json_path, 'r') as json_file:
+            data = json.load(json_file)
+        return np.array([row[:-1] for row in data], dtype=np.float32), np.array([row[-1] for row in data], dtype=np.int8)
+
+    seconds, peak_mb, _ = measure(json_load)
+    record(results, 'JSON read (json.load)', samples, 'samples', seconds, peak_mb)
+    seconds, peak_mb, _ = measure(lambda: load_dataset(json_path))
+    record(results, 'JSON read (blocks)', samples, 'samples', seconds, peak_mb)
+
+
+def bench_merge_normalize(results, tmp_directory, samples, rng):
+    in_paths = [os.path.join(tmp_directory, f"in_{k}.md4fd") for k in range(MERGE_INPUTS)]
+    for in_path in in_paths:
+        synthetic_dataset(in_path, samples // MERGE_INPUTS, rng)
+
+    merged_path = os.path.join(tmp_directory, "merged.md4fd")
+    seconds, peak_mb, merged = measure(lambda: merge_datasets(in_paths, merged_path))
+    record(results, 'merge', merged, 'samples', seconds, peak_mb)
+
+    sharded_path = os.path.join(tmp_directory, "merged.shards")
+    seconds, peak_mb, merged = measure(lambda: merge_datasets(in_paths, sharded_path))
+    record(results, 'merge (shards)', merged, 'samples', seconds, peak_mb)
+
+    normalizer = DatasetNormalizer()
+    normalizer.in_path = merged_path
+    normalizer.out_path = os.path.join(tmp_directory, "normalized.md4fd")
+    normalizer.manifest_path = os.path.join(tmp_directory, "no_manifest.json") # BAR min/max from a full scan
+
+    seconds, peak_mb, _ = measure(normalizer.normalize)
+    record(results, 'normalize', merged, 'samples', seconds, peak_mb)
+
+
+def run_synthetic_suite(report_path=None, seed=0):
+    rng = np.random.default_rng(seed)
+    results = []
+    start = time.perf_counter()
+
+    with tempfile.TemporaryDirectory() as tmp_directory:
+        for frames in VIDEO_FRAMES:
+            print(f"Synthetic video of {frames} frames")
+            video_path = os.path.join(tmp_directory, f"video_{frames}.avi")
+            synthetic_video(video_path, frames)
+
+            bench_decode(results, video_path, frames)
+            bench_extraction(results, video_path, frames)
+
+        for frames in STREAM_FRAMES:
+            print(f"Synthetic landmark stream of {frames} frames")
+            bench_windowing(results, frames, rng)
+
+        for samples in DATASET_SAMPLES:
+            print(f"Synthetic datasets of {samples} samples")
+            bench_json_read(results, tmp_directory, samples, rng)
+            bench_merge_normalize(results, tmp_directory, samples, rng)
+
+    report = {'seed': seed, 'repeats': REPEATS, 'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb(), 'results': results}
+    if report_path is not None:
+        save_report(report, report_path)
+        print(f"Benchmark report saved to {report_path}")
+
+    return report
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench_normalizer(sys.argv[1])
+    else:
+        run_synthetic_suite("~/Fall_detection_dataset/Dataset Tools/out/benchmark_report.json")
@@ -3,7 +3,67 @@ import json
 import random
 import numpy as np
 import mediapipe as mp
-from landmark_extractor import LandmarkExtractor
+from landmark_extractor import LandmarkExtractor, get_schema_extractor
+from dataset_io import open_writer, make_schema
+from landmark_features import stack_feature_vectors, sliding_windows
+from async_stages import AsyncWriter
+from frame_reader import CameraCapture
+
+
+
+class WindowRing():
+    '''
+    Ring buffer of the last size timestamped feature vectors and camera frames, preallocated once
+    '''
+    def __init__(self, size, feature_size=23):
+        self.timestamps = np.full(size, np.inf)
+        self.features = np.empty((size, feature_size))
+        self.frames = [None] * size
+        self.pos = 0
+        self.count = 0 # frames pushed since the start
+
+
+    def push(self, timestamp, feature_vector, frame):
+        self.timestamps[self.pos] = timestamp
+        self.features[self.pos] = np.array(feature_vector, dtype=np.float64) # a missing BAR (None) becomes NaN
+        self.frames[self.pos] = frame
+        self.pos = (self.pos + 1) % len(self.frames)
+        self.count += 1
+
+
+    def window_at(self, end_time, sequence_length, fps):
+        '''
+        Window of sequence_length frames at fps ending at end_time (same clock as the timestamps)
+        Every frame time takes the last frame captured at or before it, so the window always spans sequence_length/fps
+        seconds, whatever the number of frames dropped or processed in between
+        '''
+        order = self.order()
+        frame_times = end_time - np.arange(sequence_length - 1, -1, -1) / fps
+
+        held = self.held_slots(order, frame_times)
+        return self.features[order[held]], [self.frames[order[k]] for k in held]
+
+
+    def held_slots(self, order, frame_times):
+        return np.maximum(np.searchsorted(self.timestamps[order], frame_times, side='right') - 1, 0)
+
+
+    def max_hold(self, end_time, sequence_length, fps):
+        '''
+        Longest time (seconds) a frame is repeated in the window ending at end_time, see window_at
+        '''
+        order = self.order()
+        frame_times = end_time - np.arange(sequence_length - 1, -1, -1) / fps
+        held = self.held_slots(order, frame_times)
+
+        return float(np.max(frame_times - self.timestamps[order][held]))
+
+
+    def order(self):
+        # Buffer slots oldest first, slots never filled are left out
+        if self.count < len(self.frames):
+            return np.arange(self.count)
+        return np.r_[self.pos:len(self.frames), 0:self.pos]
 
 
 
@@ -23,6 +83,8 @@ class DatasetCreator:
         self.frames_counter = 0 # Set video length to be packed in the dataset
         self.out_path = "~/Fall_detection_dataset/Dataset Tools/out/custom_dataset.json"
         self.images_queue = []
+        self.ring = None # last window of the streaming capture
+        self.max_hold = 0.5 # seconds a processed frame may be repeated in a streamed window, longer holds are skipped
 
 
 
@@ -53,6 +115,63 @@ class DatasetCreator:
 
 
 
+    def stream(self):
+        '''
+        Streaming capture: runs until the camera is closed (or Ctrl+C) and writes every window to out_path as soon as
+        it is complete, windows start fps/2 frames apart as in dump_dataset.
+        The camera is read by a background thread (see frame_reader.CameraCapture): when inference is slower than the
+        camera, frames are dropped and windows are built from the capture timestamps, so a window always covers
+        coverage seconds at self.fps (frames missing in between repeat the previous processed frame).
+        Windows holding a frame for more than max_hold seconds (nobody detected, or inference stalled) are skipped, and
+        after a gap longer than a window the windowing starts again from the current frame.
+        Only the last window is kept (in a ring buffer) and windows are written by a background thread, so memory does
+        not grow with the capture length.
+        '''
+        skip = int(self.fps/2)
+        self.ring = WindowRing(self.sequence_length + skip)
+        writer = AsyncWriter(self.out_path, schema=self.get_schema())
+        camera = CameraCapture(self.camera_channel)
+        window_end = None
+        last_timestamp = None
+
+        try:
+            while True:
+                timestamp, frame = camera.read()
+                if frame is None:
+                    break
+
+                self.image_size = [frame.shape[1], frame.shape[0]]
+
+                body_landmarks, body_ar = self.landmark_extractor.get_body_landmarks(frame)
+
+                if body_landmarks and self.check_landmarks(body_landmarks):
+                    self.ring.push(timestamp, self.vectorize_landmarks(body_landmarks, body_ar), frame)
+                    label = random.randint(0,1)
+                    self.frames_counter += 1
+
+                    # Start over after a gap longer than a window, its windows would only repeat the frame before it
+                    if window_end is None or timestamp - last_timestamp > self.sequence_length / self.fps:
+                        window_end = timestamp + (self.sequence_length - 1) / self.fps
+                    last_timestamp = timestamp
+
+                    # A window ends every skip frame periods once the first one is complete
+                    while timestamp >= window_end:
+                        if self.ring.max_hold(window_end, self.sequence_length, self.fps) <= self.max_hold:
+                            features, frames = self.ring.window_at(window_end, self.sequence_length, self.fps)
+                            writer.write_sample(features, label)
+                            print(f"Written {writer.samples} samples, {camera.dropped} of {camera.captured} camera frames dropped")
+                        window_end += skip / self.fps
+
+        except KeyboardInterrupt:
+            print("Capture stopped")
+
+        finally:
+            camera.close()
+            writer.close()
+            self.camera_channel.release()
+
+
+
     def check(self):
         with open(self.out_path, 'r') as json_file:
             data = json.load(json_file)
@@ -82,41 +201,26 @@ class DatasetCreator:
         PyTorch DataLoader will load data as an array where each element is a sample related to a frame and process it frame by frame
         Each sample has 23 features (11 x,y body landmarks + body aspect ratio) and a label
         Shift window by a factor of 15 frames
+        Windows are strided views of the queue, each one is only copied when written
         '''
-        data = []        
+        skip = int(self.fps/2)
+        windows = sliding_windows(stack_feature_vectors(self.queue), self.sequence_length, skip)
 
         # Write data rows
-        for i in range(0, len(self.queue) - self.sequence_length + 1, int(self.fps/2)):
-            print(f"writing strting from i {i}")
-            # Flatten the sequence of feature vectors into a single row
-            row = []
-            for j in range(self.sequence_length):
-                row.append(self.queue[i + j])
-            
-            print(f"Writing from {i} to {i+j}")
-            
-            if self.labels[i+j] is not None:
-                row.append(self.labels[i+j])
-            
-            data.append(row)
-
-        with open(self.out_path, 'w') as json_file:
-            json_file.write('[\n')
-            for row_idx, row in enumerate(data):
-                json_file.write('  [\n')
-                for vector_idx, vector in enumerate(row):
-                    vector_str = '    ' + json.dumps(vector)
-                    if vector_idx < len(row) - 1:
-                        json_file.write(f'{vector_str},\n')
-                    else:
-                        json_file.write(f'{vector_str}\n')
-                if row_idx < len(data) - 1:
-                    json_file.write('  ],\n')
-                else:
-                    json_file.write('  ]\n')
-            json_file.write(']\n')
+        with open_writer(self.out_path, self.get_schema()) as writer:
+            for k, window in enumerate(windows):
+                i = k * skip
+                print(f"Writing from {i} to {i + self.sequence_length - 1}")
+
+                writer.write_sample(window, self.labels[i + self.sequence_length - 1])
 
             
+    def get_schema(self):
+        # Feature vectors follow landmarks_keys, which is not the order of the dataset processors
+        extractor = get_schema_extractor(self.landmark_extractor.get_settings(), None) # camera frames are not downscaled
+        return make_schema(self.landmarks_keys, self.fps, self.sequence_length, extractor)
+
+
     def vectorize_landmarks(self, landmarks, body_ar):
         input_vector = []
         for key in self.landmarks_keys:
@@ -146,4 +250,4 @@ class DatasetCreator:
 
 if __name__ == "__main__":
     dataset_creator = DatasetCreator()
-    dataset_creator.start()
\ No newline at end of file
+    dataset_creator.stream() # start() captures 1000 frames and writes the dataset at the end
\ No newline at end of file
@@ -0,0 +1,728 @@
+import os
+import sys
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from landmark_features import KEYPOINT_NAMES
+
+'''
+Dataset readers and writers
+A dataset is a list of samples, each sample being sequence_length feature vectors (22 landmark coordinates + BAR)
+followed by its label (Fall 1 / ADL 0).
+
+Three formats are supported, chosen from the output path:
+ - binary (path ending with .md4fd): a folder holding
+       meta.json      number of samples, frames per sample and features per frame
+       features.bin   float32 array of shape samples x frames x 23 (C order), a missing BAR is stored as NaN
+       labels.bin     int8 array of shape samples
+   both arrays can be memory-mapped, see load_dataset
+ - sharded (path ending with .shards): a folder holding
+       index.json             number of samples, shard size, schema and for every shard its path, offset (index of its
+                              first sample in the dataset) and label counts
+       shard_00000.md4fd ...  binary datasets of SHARD_SIZE samples (the last one may be shorter), each with its own
+                              index.json: offset, label, source and subject of every sample
+   shards are written in parallel (see ShardedDatasetWriter) and can be read concurrently, the indexes give the
+   labels and origin of the samples without reading them, see dataset_loader.ShardedDataset
+ - JSON (any other path): the legacy pretty-printed layout with one feature vector per line (see dump_json)
+   files in this layout are read by blocks straight into NumPy arrays (see iter_json_blocks), any other JSON file is
+   parsed in full with json.load
+
+Samples may be tagged with their source (recording or input dataset) and subject when they are written. Tags are
+recorded by the binary (tags.json, only when some sample has one) and sharded formats, the JSON format ignores them.
+
+Schema: writers given a schema (see make_schema) store it in meta.json (binary) or in a <path>.schema.json sidecar
+(JSON, so that the dataset file keeps the legacy layout). It records the order of the keypoints in the feature
+vectors, the frame rate, the window length, the BAR definition and the extractor settings, so that the layout of a
+dataset can be checked without reading its samples. iter_samples and dataset_loader.MD4FDDataset remap the columns
+to the canonical KEYPOINT_NAMES order on read. Datasets with no schema are taken as already in canonical order.
+'''
+
+BINARY_EXTENSION = ".md4fd"
+SHARDS_EXTENSION = ".shards"
+FORMAT_VERSION = 1
+FEATURES_FILE = "features.bin"
+LABELS_FILE = "labels.bin"
+META_FILE = "meta.json"
+TAGS_FILE = "tags.json"
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+SHARD_SIZE = 4096   # samples per shard
+SHARD_WORKERS = 4   # shards written at the same time
+JSON_BLOCK_SIZE = 1 << 22   # bytes of a JSON dataset parsed at a time
+JSON_SEPARATORS = bytes.maketrans(b'[],\r\n', b'     ')
+FEATURE_SIZE = 23
+BAR_INDEX = 22  # 23rd element (0-indexed, so it's index 22)
+SCHEMA_VERSION = 1
+SCHEMA_SUFFIX = ".schema.json"
+BAR_DEFINITION = ("max vertical / max horizontal pixel distance between a shoulder and the opposite knee "
+                  "(horizontal distance 0 taken as 1), null/NaN when nobody is detected")
+
+
+def is_binary_path(path):
+    return os.path.normpath(path).endswith(BINARY_EXTENSION)
+
+
+def is_sharded_path(path):
+    return os.path.normpath(path).endswith(SHARDS_EXTENSION)
+
+
+def get_shard_path(path, k):
+    return os.path.join(path, f"shard_{k:05d}{BINARY_EXTENSION}")
+
+
+def save_json(data, path, indent=1):
+    # Written to a temporary file first then renamed, readers never see a partially written file
+    with open(path + ".tmp", 'w') as json_file:
+        json.dump(data, json_file, indent=indent)
+    os.replace(path + ".tmp", path)
+
+
+def make_schema(keypoints, fps, sequence_length, extractor):
+    '''
+    Schema of a dataset: keypoints is the order of the (x, y) pairs in a feature vector, fps the frame rate of the
+    windows, sequence_length their number of frames, extractor the landmark extractor settings and version
+    '''
+    return {'schema_version': SCHEMA_VERSION, 'keypoints': list(keypoints), 'features': "x, y of every keypoint, then BAR",
+            'fps': fps, 'sequence_length': sequence_length, 'bar': BAR_DEFINITION, 'extractor': extractor}
+
+
+def get_schema_path(path):
+    return os.path.normpath(path) + SCHEMA_SUFFIX
+
+
+def save_schema(schema, path):
+    save_json(schema, get_schema_path(path), indent=2)
+
+
+def load_schema(path):
+    '''
+    Schema of a dataset, None if it was written without one
+    '''
+    if is_binary_path(path):
+        return load_meta(path).get('schema')
+    if is_sharded_path(path):
+        return load_index(path).get('schema')
+
+    if not os.path.exists(get_schema_path(path)):
+        return None
+    with open(get_schema_path(path), 'r') as schema_file:
+        return json.load(schema_file)
+
+
+def get_schema_columns(schema, keypoints=KEYPOINT_NAMES):
+    '''
+    Column indices that reorder the feature vectors of a dataset with the given schema into the keypoints order,
+    None when no reordering is needed (same order or no schema)
+    '''
+    if schema is None or list(schema['keypoints']) == list(keypoints):
+        return None
+
+    missing = [key for key in keypoints if key not in schema['keypoints']]
+    if missing:
+        raise ValueError(f"Dataset has no {missing} keypoints, its keypoints are {schema['keypoints']}")
+
+    columns = []
+    for key in keypoints:
+        k = schema['keypoints'].index(key)
+        columns += [2*k, 2*k + 1]
+    columns.append(BAR_INDEX)
+
+    return np.array(columns)
+
+
+def check_schemas(schemas):
+    '''
+    Raise ValueError when datasets cannot be merged: windows of different frame rates or lengths
+    Return the schema of the merged dataset (keypoints in canonical order), None if no dataset has a schema
+    extractor is kept when every dataset was extracted with the same settings, otherwise it is the list of the
+    distinct settings
+    '''
+    schemas = [schema for schema in schemas if schema is not None]
+    if not schemas:
+        return None
+
+    for key in ('fps', 'sequence_length'):
+        values = set(schema[key] for schema in schemas)
+        if len(values) > 1:
+            raise ValueError(f"Datasets have different {key}: {sorted(values)}")
+
+    extractors = []
+    for schema in schemas:
+        if schema['extractor'] not in extractors:
+            extractors.append(schema['extractor'])
+
+    schema = dict(schemas[0])
+    schema['keypoints'] = list(KEYPOINT_NAMES)
+    schema['extractor'] = extractors[0] if len(extractors) == 1 else extractors
+    return schema
+
+
+def dump_json(data, out_path):
+
+    with open(out_path, 'w') as json_file:
+        json_file.write('[\n')
+        for row_idx, row in enumerate(data):
+            json_file.write('  [\n')
+            for vector_idx, vector in enumerate(row):
+                vector_str = '    ' + json.dumps(vector)
+                if vector_idx < len(row) - 1:
+                    json_file.write(f'{vector_str},\n')
+                else:
+                    json_file.write(f'{vector_str}\n')
+            if row_idx < len(data) - 1:
+                json_file.write('  ],\n')
+            else:
+                json_file.write('  ]\n')
+        json_file.write(']\n')
+
+
+
+class JsonDatasetWriter():
+    '''
+    Streaming version of dump_json, samples are written as they come and the output is byte-identical
+    '''
+    def __init__(self, out_path, schema=None):
+        self.out_path = out_path
+        self.schema = schema
+        self.samples = 0
+
+        self.json_file = open(out_path, 'w')
+        self.json_file.write('[\n')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def write(self, row):
+        if self.samples > 0:
+            self.json_file.write(',\n')
+
+        self.json_file.write('  [\n')
+        for vector_idx, vector in enumerate(row):
+            vector_str = '    ' + json.dumps(vector)
+            if vector_idx < len(row) - 1:
+                self.json_file.write(f'{vector_str},\n')
+            else:
+                self.json_file.write(f'{vector_str}\n')
+        self.json_file.write('  ]')
+
+        self.samples += 1
+
+
+    def write_sample(self, features, label, source=None, subject=None):
+        row = [[None if np.isnan(value) else value for value in vector] for vector in np.asarray(features, dtype=np.float64).tolist()]
+        row.append(int(label))
+        self.write(row)
+
+
+    def write_batch(self, features, labels, sources=None, subjects=None):
+        for sample, label in zip(features, labels):
+            self.write_sample(sample, label)
+
+
+    def close(self):
+        if self.json_file.closed:
+            return
+
+        if self.samples > 0:
+            self.json_file.write('\n')
+        self.json_file.write(']\n')
+        self.json_file.close()
+
+        if self.schema is not None:
+            save_schema(self.schema, self.out_path)
+
+
+
+class BinaryDatasetWriter():
+    '''
+    Streaming writer of the binary format, meta.json (and tags.json) is written on close
+    '''
+    def __init__(self, out_path, schema=None):
+        self.out_path = out_path
+        self.schema = schema
+        self.samples = 0
+        self.frames = None
+        self.sources = []
+        self.subjects = []
+
+        os.makedirs(out_path, exist_ok=True)
+        self.features_file = open(os.path.join(out_path, FEATURES_FILE), 'wb')
+        self.labels_file = open(os.path.join(out_path, LABELS_FILE), 'wb')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def write(self, row):
+        self.write_sample(row[:-1], row[-1])
+
+
+    def write_sample(self, features, label, source=None, subject=None):
+        features = np.asarray(features, dtype=np.float32)
+
+        if self.frames is None:
+            self.frames = features.shape[0]
+        if features.shape != (self.frames, FEATURE_SIZE):
+            raise ValueError(f"Sample of shape {features.shape} does not match ({self.frames}, {FEATURE_SIZE})")
+
+        self.features_file.write(features.astype('<f4', copy=False).tobytes())
+        self.labels_file.write(np.int8(label).tobytes())
+        self.sources.append(source)
+        self.subjects.append(subject)
+        self.samples += 1
+
+
+    def write_batch(self, features, labels, sources=None, subjects=None):
+        features = np.asarray(features, dtype=np.float32)
+        if len(features) == 0:
+            return
+
+        if self.frames is None:
+            self.frames = features.shape[1]
+        if features.shape[1:] != (self.frames, FEATURE_SIZE):
+            raise ValueError(f"Samples of shape {features.shape[1:]} do not match ({self.frames}, {FEATURE_SIZE})")
+
+        self.features_file.write(features.astype('<f4', copy=False).tobytes())
+        self.labels_file.write(np.asarray(labels, dtype=np.int8).tobytes())
+        self.sources += list(sources) if sources is not None else [None] * len(features)
+        self.subjects += list(subjects) if subjects is not None else [None] * len(features)
+        self.samples += len(features)
+
+
+    def close(self):
+        if self.features_file.closed:
+            return
+
+        self.features_file.close()
+        self.labels_file.close()
+
+        meta = {'format': 'md4fd', 'version': FORMAT_VERSION, 'samples': self.samples,
+                'frames': self.frames if self.frames is not None else 0, 'features': FEATURE_SIZE}
+        if self.schema is not None:
+            meta['schema'] = self.schema
+        with open(os.path.join(self.out_path, META_FILE), 'w') as meta_file:
+            json.dump(meta, meta_file, indent=2)
+
+        tags_path = os.path.join(self.out_path, TAGS_FILE)
+        if any(tag is not None for tag in self.sources + self.subjects):
+            save_json({'sources': self.sources, 'subjects': self.subjects}, tags_path)
+        elif os.path.exists(tags_path):
+            os.remove(tags_path)
+
+
+
+def write_shard(shard_path, features, labels, shard_index, schema):
+    with BinaryDatasetWriter(shard_path, schema) as writer:
+        writer.write_batch(features, labels)
+    save_json(shard_index, os.path.join(shard_path, INDEX_FILE))
+
+
+
+class ShardedDatasetWriter():
+    '''
+    Streaming writer of the sharded format
+    Samples are copied into a shard buffer, every full shard is handed to a pool of workers threads which write it
+    while the next one is filled (file writes release the GIL). At most workers shards wait to be written, so memory
+    is bounded by workers + 1 shards. index.json is written on close, once every shard is on disk.
+    '''
+    def __init__(self, out_path, schema=None, shard_size=SHARD_SIZE, workers=SHARD_WORKERS):
+        self.out_path = out_path
+        self.schema = schema
+        self.shard_size = shard_size
+        self.workers = workers
+        self.samples = 0
+        self.frames = None
+        self.shards = []
+        self.pending = []
+
+        self.features = None
+        self.labels = None
+        self.sources = []
+        self.subjects = []
+
+        os.makedirs(out_path, exist_ok=True)
+        self.executor = ThreadPoolExecutor(workers)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def write(self, row):
+        self.write_sample(row[:-1], row[-1])
+
+
+    def write_sample(self, features, label, source=None, subject=None):
+        features = np.asarray(features, dtype=np.float32)
+
+        if self.frames is None:
+            self.frames = features.shape[0]
+        if features.shape != (self.frames, FEATURE_SIZE):
+            raise ValueError(f"Sample of shape {features.shape} does not match ({self.frames}, {FEATURE_SIZE})")
+
+        if self.features is None:
+            self.features = np.empty((self.shard_size, self.frames, FEATURE_SIZE), dtype=np.float32)
+            self.labels = np.empty(self.shard_size, dtype=np.int8)
+
+        n = len(self.sources)
+        self.features[n] = features
+        self.labels[n] = label
+        self.sources.append(source)
+        self.subjects.append(subject)
+        self.samples += 1
+
+        if n + 1 == self.shard_size:
+            self.flush()
+
+
+    def write_batch(self, features, labels, sources=None, subjects=None):
+        for k in range(len(labels)):
+            self.write_sample(features[k], labels[k], sources[k] if sources is not None else None,
+                              subjects[k] if subjects is not None else None)
+
+
+    def flush(self):
+        # Hand the current shard to the workers, waiting for the oldest one when workers shards are pending
+        n = len(self.sources)
+        if n == 0:
+            return
+
+        k = len(self.shards)
+        offset = self.samples - n
+        labels, counts = np.unique(self.labels[:n], return_counts=True)
+        self.shards.append({'path': os.path.basename(get_shard_path(self.out_path, k)), 'offset': offset, 'samples': n,
+                            'labels': {str(label): int(count) for label, count in zip(labels, counts)}})
+        shard_index = {'offset': offset, 'labels': self.labels[:n].tolist(), 'sources': self.sources, 'subjects': self.subjects}
+
+        if len(self.pending) >= self.workers:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(write_shard, get_shard_path(self.out_path, k), self.features[:n],
+                                                 self.labels[:n], shard_index, self.schema))
+
+        self.features = None
+        self.labels = None
+        self.sources = []
+        self.subjects = []
+
+
+    def close(self):
+        if self.executor is None:
+            return
+
+        self.flush()
+        try:
+            for future in self.pending:
+                future.result()
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+
+        index = {'format': 'md4fd-shards', 'version': INDEX_VERSION, 'samples': self.samples,
+                 'frames': self.frames if self.frames is not None else 0, 'features': FEATURE_SIZE,
+                 'shard_size': self.shard_size, 'shards': self.shards}
+        if self.schema is not None:
+            index['schema'] = self.schema
+        save_json(index, os.path.join(self.out_path, INDEX_FILE))
+
+
+
+def open_writer(out_path, schema=None):
+    if is_sharded_path(out_path):
+        return ShardedDatasetWriter(out_path, schema)
+    if is_binary_path(out_path):
+        return BinaryDatasetWriter(out_path, schema)
+    return JsonDatasetWriter(out_path, schema)
+
+
+def save_dataset(data, out_path, schema=None):
+    '''
+    Write a list of samples (feature vectors + label) in the format given by out_path
+    '''
+    if is_sharded_path(out_path):
+        with ShardedDatasetWriter(out_path, schema) as writer:
+            for row in data:
+                writer.write(row)
+        return
+
+    if not is_binary_path(out_path):
+        dump_json(data, out_path)
+        if schema is not None:
+            save_schema(schema, out_path)
+        return
+
+    with BinaryDatasetWriter(out_path, schema) as writer:
+        for row in data:
+            writer.write(row)
+
+
+def load_meta(path):
+    with open(os.path.join(path, META_FILE), 'r') as meta_file:
+        return json.load(meta_file)
+
+
+def load_index(path, shard=None):
+    '''
+    index.json of a sharded dataset, or of one of its shards (an entry of the index shards list)
+    '''
+    index_path = os.path.join(path, shard['path'], INDEX_FILE) if shard is not None else os.path.join(path, INDEX_FILE)
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)
+
+
+def load_tags(path):
+    '''
+    (sources, subjects) lists with the tags of every sample, None for the datasets with no tags
+    '''
+    if is_sharded_path(path):
+        sources = []
+        subjects = []
+        for shard in load_index(path)['shards']:
+            shard_index = load_index(path, shard)
+            sources += shard_index['sources']
+            subjects += shard_index['subjects']
+        return sources, subjects
+
+    tags_path = os.path.join(path, TAGS_FILE)
+    if not is_binary_path(path) or not os.path.exists(tags_path):
+        return None
+    with open(tags_path, 'r') as tags_file:
+        tags = json.load(tags_file)
+    return tags['sources'], tags['subjects']
+
+
+def load_dataset(path, mmap_mode=None):
+    '''
+    Return (features, labels) arrays of shape (samples, frames, 23) and (samples,)
+    Binary datasets are memory-mapped when mmap_mode is given ('r', 'r+' or 'c' as in np.memmap),
+    JSON datasets are always fully parsed and sharded datasets fully loaded (see dataset_loader.ShardedDataset)
+    '''
+    if is_sharded_path(path):
+        index = load_index(path)
+        shards = [load_dataset(os.path.join(path, shard['path'])) for shard in index['shards']]
+        if not shards:
+            return np.zeros((0, index['frames'], FEATURE_SIZE), dtype=np.float32), np.zeros(0, dtype=np.int8)
+        return np.concatenate([features for features, labels in shards]), np.concatenate([labels for features, labels in shards])
+
+    if not is_binary_path(path) and is_json_layout(path):
+        blocks = list(iter_json_blocks(path))
+        if not blocks:
+            return np.zeros((0, 0, FEATURE_SIZE), dtype=np.float32), np.zeros(0, dtype=np.int8)
+        return np.concatenate([features for features, labels in blocks]), np.concatenate([labels for features, labels in blocks])
+
+    if not is_binary_path(path):
+        with open(path, 'r') as json_file:
+            data = json.load(json_file)
+
+        if len(data) == 0:
+            return np.zeros((0, 0, FEATURE_SIZE), dtype=np.float32), np.zeros(0, dtype=np.int8)
+
+        features = np.array([row[:-1] for row in data], dtype=np.float32)
+        labels = np.array([row[-1] for row in data], dtype=np.int8)
+        return features, labels
+
+    meta = load_meta(path)
+    shape = (meta['samples'], meta['frames'], meta['features'])
+    features_path = os.path.join(path, FEATURES_FILE)
+    labels_path = os.path.join(path, LABELS_FILE)
+
+    if mmap_mode is None or meta['samples'] == 0:
+        features = np.fromfile(features_path, dtype='<f4').reshape(shape)
+        labels = np.fromfile(labels_path, dtype=np.int8)
+    else:
+        features = np.memmap(features_path, dtype='<f4', mode=mmap_mode, shape=shape)
+        labels = np.memmap(labels_path, dtype=np.int8, mode=mmap_mode, shape=(meta['samples'],))
+
+    return features, labels
+
+
+def is_json_layout(path):
+    # Files written by dump_json / JsonDatasetWriter start with a '[' line and, unless empty, a '  [' line followed by
+    # a whole feature vector on one line ('    [0.1, ...'), json.dump with an indent puts every value on its own line
+    with open(path, 'rb') as json_file:
+        first = json_file.readline().rstrip(b'\r\n')
+        second = json_file.readline().rstrip(b'\r\n')
+        third = json_file.readline().rstrip(b'\r\n')
+
+    if first != b'[':
+        return False
+    if second in (b']', b''):
+        return True
+    return second == b'  [' and third.startswith(b'    [') and len(third) > len(b'    [')
+
+
+def iter_json_blocks(path, block_size=JSON_BLOCK_SIZE):
+    '''
+    Yield (features, labels) arrays of shape (samples, frames, 23) and (samples,) of a JSON dataset in the dump_json
+    layout, about block_size bytes of consecutive samples at a time
+    Every sample ends with a '  ]' line, so a block is cut after the last one it holds. Brackets, commas and line breaks
+    (CRLF included) are blanked and the numbers of the block are parsed at once by np.fromstring, no Python list is
+    built. null values (missing BAR) are read as NaN.
+    '''
+    frames = None
+    rest = b''
+
+    with open(path, 'rb') as json_file:
+        while True:
+            chunk = json_file.read(block_size)
+            text = rest + chunk
+
+            end = len(text)
+            if chunk:
+                cut = text.rfind(b'\n  ]')
+                end = text.find(b'\n', cut + 1) if cut >= 0 else -1
+                if end < 0:
+                    rest = text # a sample longer than block_size, read on
+                    continue
+            block, rest = text[:end], text[end:]
+
+            samples = block.count(b'\n  ]')
+            if samples == 0 and block.translate(JSON_SEPARATORS).strip():
+                # Only the closing bracket may follow the last sample, anything else is not in the dump_json layout
+                raise ValueError(f"{path} holds values outside of samples in the dump_json layout")
+            if samples > 0:
+                if frames is None:
+                    frames = block[:block.find(b'\n  ]')].count(b'\n    [')
+
+                values = np.fromstring(block.translate(JSON_SEPARATORS).replace(b'null', b'nan'), dtype=np.float64, sep=' ')
+                if values.size != samples * (frames * FEATURE_SIZE + 1):
+                    raise ValueError(f"{path} does not hold samples of {frames} x {FEATURE_SIZE} features in the dump_json layout")
+
+                rows = values.reshape(samples, -1)
+                yield rows[:, :-1].reshape(samples, frames, FEATURE_SIZE).astype(np.float32), rows[:, -1].astype(np.int8)
+
+            if not chunk:
+                return
+
+
+def iter_json_samples(path):
+    '''
+    Yield the rows (feature vectors + label) of a JSON dataset one at a time
+    Files in the dump_json layout are parsed one sample at a time, any other JSON file is loaded in full
+    '''
+    with open(path, 'r') as json_file:
+        if not is_json_layout(path):
+            yield from json.load(json_file)
+            return
+        json_file.readline()
+
+        lines = None
+        for line in json_file:
+            stripped = line.strip()
+            if lines is None:
+                if stripped == '[':
+                    lines = []
+            elif stripped in (']', '],'):
+                yield json.loads('[' + ''.join(lines) + ']')
+                lines = None
+            else:
+                lines.append(stripped)
+
+
+def iter_samples(path, keypoints=KEYPOINT_NAMES):
+    '''
+    Yield (features, label) of every sample of a dataset, features is a writable (frames, 23) float32 array with the
+    keypoints in the given order (see the schema)
+    Only one sample at a time is held in memory, whatever the format
+    '''
+    if is_sharded_path(path):
+        for shard in load_index(path)['shards']:
+            yield from iter_samples(os.path.join(path, shard['path']), keypoints)
+        return
+
+    columns = get_schema_columns(load_schema(path), keypoints)
+
+    if not is_binary_path(path) and is_json_layout(path):
+        for features, labels in iter_json_blocks(path):
+            if columns is not None:
+                features = features[:, :, columns]
+            for sample, label in zip(features, labels):
+                yield sample, int(label)
+        return
+
+    if not is_binary_path(path):
+        for row in iter_json_samples(path):
+            features = np.array(row[:-1], dtype=np.float32)
+            yield features if columns is None else features[:, columns], int(row[-1])
+        return
+
+    features, labels = load_dataset(path, mmap_mode='r')
+    for sample, label in zip(features, labels):
+        yield np.array(sample) if columns is None else sample[:, columns], int(label)
+
+
+def iter_batches(path):
+    '''
+    Yield (features, labels) arrays of consecutive samples of a dataset as stored (no keypoint remapping), a block of
+    a JSON dataset in the dump_json layout, a shard or SHARD_SIZE samples of a binary dataset at a time
+    '''
+    if is_sharded_path(path):
+        for shard in load_index(path)['shards']:
+            yield from iter_batches(os.path.join(path, shard['path']))
+        return
+
+    if not is_binary_path(path) and is_json_layout(path):
+        yield from iter_json_blocks(path)
+        return
+
+    features, labels = load_dataset(path, mmap_mode='r')
+    for start in range(0, len(labels), SHARD_SIZE):
+        yield np.array(features[start:start + SHARD_SIZE]), np.array(labels[start:start + SHARD_SIZE])
+
+
+def convert_dataset(in_path, out_path):
+    '''
+    Convert a dataset between the JSON, binary and sharded formats, keeping the schema and the sample tags
+    Samples are converted a batch at a time, memory stays bounded except for JSON files not in the dump_json layout
+    '''
+    sources, subjects = load_tags(in_path) or (None, None)
+    start = 0
+
+    with open_writer(out_path, load_schema(in_path)) as writer:
+        for features, labels in iter_batches(in_path):
+            stop = start + len(labels)
+            writer.write_batch(features, labels, sources[start:stop] if sources is not None else None,
+                               subjects[start:stop] if subjects is not None else None)
+            start = stop
+
+    return start
+
+
+def convert_directory(in_directory, out_directory, extension=BINARY_EXTENSION):
+    '''
+    Convert every JSON dataset of in_directory to out_directory, in the format given by extension
+    '''
+    os.makedirs(out_directory, exist_ok=True)
+
+    for file in sorted(os.listdir(in_directory)):
+        if not file.endswith(".json") or file.endswith(SCHEMA_SUFFIX):
+            continue
+
+        out_path = os.path.join(out_directory, os.path.splitext(file)[0] + extension)
+        samples = convert_dataset(os.path.join(in_directory, file), out_path)
+        print(f"Converted {file}: {samples} samples to {out_path}")
+
+
+
+if __name__ == "__main__":
+    # e.g. python dataset_io.py out/final_normalized_dataset.json out/final_normalized_dataset.md4fd (or .shards)
+    #      python dataset_io.py Data_Files/ Data_Files_md4fd/   (every JSON dataset of the folder to .md4fd)
+    if os.path.isdir(sys.argv[1]) and not is_binary_path(sys.argv[1]) and not is_sharded_path(sys.argv[1]):
+        convert_directory(sys.argv[1], sys.argv[2])
+    else:
+        convert_dataset(sys.argv[1], sys.argv[2])
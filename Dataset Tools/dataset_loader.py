@@ -0,0 +1,211 @@
+import os
+import numpy as np
+
+from dataset_io import is_binary_path, is_sharded_path, load_dataset, load_schema, load_index, get_schema_columns
+from landmark_features import KEYPOINT_NAMES
+
+'''
+Lazy access to an MD4FD dataset for training and post-processing
+Binary (.md4fd) datasets are memory-mapped: samples are only read from disk when they are accessed, so the dataset
+can be larger than RAM. JSON datasets have no fixed layout on disk and are fully loaded, convert them with
+dataset_io.convert_dataset to get the lazy behaviour.
+
+The class follows the map-style dataset protocol (__len__ / __getitem__), so it can be wrapped as is by a PyTorch
+DataLoader.
+Samples are returned with their keypoints in the keypoints order (canonical KEYPOINT_NAMES by default): datasets
+whose schema has another order are remapped on read, see dataset_io.get_schema_columns.
+
+Sharded (.shards) datasets are read by ShardedDataset, with the same interface: every shard is memory-mapped on its
+own, so shards can be read concurrently (e.g. one per DataLoader worker, see shard()), and the shard indexes give the
+label, source and subject of every sample without reading it (see select()). open_dataset picks the class from the path.
+'''
+
+
+class MD4FDDataset():
+    def __init__(self, path, keypoints=KEYPOINT_NAMES):
+        self.path = path
+        self.features, self.labels = load_dataset(path, mmap_mode='r' if is_binary_path(path) else None)
+
+        self.schema = load_schema(path)
+        self.columns = get_schema_columns(self.schema, keypoints)
+
+
+    def __len__(self):
+        return self.features.shape[0]
+
+
+    def __getitem__(self, idx):
+        '''
+        Return (features, label) of a sample, features is a (frames, 23) float32 array
+        '''
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Sample {idx} out of range for a dataset of {len(self)} samples")
+
+        return self.remap(np.array(self.features[idx])), int(self.labels[idx])
+
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+    @property
+    def frames(self):
+        return self.features.shape[1]
+
+
+    @property
+    def feature_size(self):
+        return self.features.shape[2]
+
+
+    def remap(self, features):
+        # Reorder the columns of samples read from disk (..., 23) to the requested keypoints order
+        if self.columns is None:
+            return features
+        return features[..., self.columns]
+
+
+    def take(self, indices):
+        '''
+        Return (features, labels) of the given samples, reading only those from disk
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        order = np.argsort(indices)     # read the memory map sequentially, then restore the requested order
+
+        features = np.empty((len(indices),) + self.features.shape[1:], dtype=np.float32)
+        labels = np.empty(len(indices), dtype=np.int8)
+        features[order] = self.features[indices[order]]
+        labels[order] = self.labels[indices[order]]
+
+        return self.remap(features), labels
+
+
+    def iter_batches(self, batch_size, shuffle=False, seed=None):
+        '''
+        Yield (features, labels) arrays of at most batch_size samples
+        Without shuffle consecutive samples are read, otherwise batches follow a random permutation of the dataset
+        '''
+        if not shuffle:
+            for start in range(0, len(self), batch_size):
+                yield self.remap(np.array(self.features[start:start + batch_size])), np.array(self.labels[start:start + batch_size])
+            return
+
+        permutation = np.random.default_rng(seed).permutation(len(self))
+        for start in range(0, len(self), batch_size):
+            yield self.take(permutation[start:start + batch_size])
+
+
+
+class ShardedDataset():
+    def __init__(self, path, keypoints=KEYPOINT_NAMES):
+        self.path = path
+        self.keypoints = keypoints
+        self.index = load_index(path)
+        self.schema = self.index.get('schema')
+        self.offsets = np.array([shard['offset'] for shard in self.index['shards']] + [self.index['samples']], dtype=np.int64)
+        self.shards = {}
+        self.shard_indexes = None
+
+
+    def __len__(self):
+        return self.index['samples']
+
+
+    def __getitem__(self, idx):
+        '''
+        Return (features, label) of a sample, features is a (frames, 23) float32 array
+        '''
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Sample {idx} out of range for a dataset of {len(self)} samples")
+
+        k = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        return self.shard(k)[idx - self.offsets[k]]
+
+
+    def __iter__(self):
+        for k in range(self.num_shards):
+            yield from self.shard(k)
+
+
+    @property
+    def frames(self):
+        return self.index['frames']
+
+
+    @property
+    def feature_size(self):
+        return self.index['features']
+
+
+    @property
+    def num_shards(self):
+        return len(self.index['shards'])
+
+
+    def shard(self, k):
+        '''
+        MD4FDDataset of the k-th shard, memory-mapped on first access
+        '''
+        if k not in self.shards:
+            self.shards[k] = MD4FDDataset(os.path.join(self.path, self.index['shards'][k]['path']), self.keypoints)
+        return self.shards[k]
+
+
+    def select(self, label=None, source=None, subject=None):
+        '''
+        Indices of the samples with the given label, source and subject (None matches any), read from the shard
+        indexes only, e.g. to draw a validation set with take()
+        '''
+        if self.shard_indexes is None:
+            self.shard_indexes = [load_index(self.path, shard) for shard in self.index['shards']]
+
+        indices = []
+        for shard_index in self.shard_indexes:
+            for j, tags in enumerate(zip(shard_index['labels'], shard_index['sources'], shard_index['subjects'])):
+                if all(value is None or value == tag for value, tag in zip((label, source, subject), tags)):
+                    indices.append(shard_index['offset'] + j)
+
+        return np.array(indices, dtype=np.int64)
+
+
+    def take(self, indices):
+        '''
+        Return (features, labels) of the given samples, reading only those from disk
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+
+        features = np.empty((len(indices), self.frames, self.feature_size), dtype=np.float32)
+        labels = np.empty(len(indices), dtype=np.int8)
+        for k in np.unique(shard_ids):
+            mask = shard_ids == k
+            features[mask], labels[mask] = self.shard(k).take(indices[mask] - self.offsets[k])
+
+        return features, labels
+
+
+    def iter_batches(self, batch_size, shuffle=False, seed=None):
+        '''
+        Yield (features, labels) arrays of at most batch_size samples
+        Without shuffle consecutive samples are read, otherwise batches follow a random permutation of the dataset
+        '''
+        if not shuffle:
+            for start in range(0, len(self), batch_size):
+                yield self.take(np.arange(start, min(start + batch_size, len(self))))
+            return
+
+        permutation = np.random.default_rng(seed).permutation(len(self))
+        for start in range(0, len(self), batch_size):
+            yield self.take(permutation[start:start + batch_size])
+
+
+
+def open_dataset(path, keypoints=KEYPOINT_NAMES):
+    if is_sharded_path(path):
+        return ShardedDataset(path, keypoints)
+    return MD4FDDataset(path, keypoints)
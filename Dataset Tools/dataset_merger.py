@@ -1,66 +1,294 @@
 import os
 import json
-import random
+import shutil
+import tempfile
+import numpy as np
+
+from dataset_io import BinaryDatasetWriter, open_writer, iter_samples, load_dataset, load_schema, load_tags, check_schemas, save_json, BAR_INDEX, SCHEMA_SUFFIX
+from landmark_cache import hash_source
+
+'''
+Merge every dataset of input_directory into a single shuffled dataset
+Inputs are read one sample at a time and shuffled out of core in two passes:
+ 1. samples are gathered in chunks of chunk_size, each chunk is shuffled in memory and written to a temporary file
+ 2. chunks are randomly interleaved (a uniform shuffle of the chunk ids repeated by chunk size) while reading each of
+    them sequentially, which gives a uniformly shuffled output
+Memory is bounded by chunk_size samples, whatever the number and size of the inputs.
+Inputs are read with their keypoints remapped to the canonical order and must have the same window frame rate and
+length (checked on their schemas before reading any sample), the output gets the canonical schema.
+Every sample is tagged with the name of its input dataset as source, subjects recorded by the inputs are kept. With a
+.shards out_path the output is written as shards in parallel, their indexes hold the tags (see dataset_io).
+Samples are held in float32, the precision of the binary format, for any input and output format: a JSON output
+holds the float32 values written as doubles (15.4 is written 15.399999618530273).
+
+Incremental merge: every input is first repaired and staged as a binary dataset in staging_directory, and a
+manifest records its content hash, sample count, offset in the merged (unshuffled) order and BAR min/max.
+On the next run only the inputs whose hash changed are read again, the shuffled output is rebuilt from the staged
+binaries and the normalizer can take the BAR min/max from the manifest instead of scanning the dataset. The manifest
+stamps the output (size and modification time), so an output rewritten by anything else (e.g. a full merge) is not
+taken for the one it describes.
+'''
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 2  # 2: staged datasets hold the sample tags
+
 
 def main():
     input_directory = "~/Fall_detection_dataset/Dataset Tools/Data_Files"
-    out_path = "~/Fall_detection_dataset/Dataset Tools/out/final_merged_dataset.json"
-    global_dataset = []
-    tot_samples = 0
-
-    for file in os.listdir(input_directory):
-        file_path = os.path.join(input_directory, file)
-
-        with open(file_path, 'r') as json_file:
-            data = json.load(json_file)
-        tot_samples = tot_samples + len(data)
-        previous_bar = None
-
-        for sample in data:
-            for frame_data in sample[:-1]:
-                # Adjusting Body aspect ratio 
-
-                if frame_data[22] is None:
-                    frame_data[22] = previous_bar
-                elif frame_data[22] > 40:
-                    frame_data[22] = frame_data[22]/10 # suppose a 10 px body width 
-                
-                previous_bar = frame_data[22]
-
-                # if (frame_data[22] < 0) or  (frame_data[22] > 40) or (frame_data[22] is None):
-                #     print("Error")
-        
-            global_dataset.append(sample)
-    
-    if len(global_dataset) == tot_samples:
-        random.shuffle(global_dataset) # perform shuffling
-        random.shuffle(global_dataset)
-        
-        # Check dimensions after shuffling
-        print(len(global_dataset))
-        print(len(global_dataset[0]))
-        print(len(global_dataset[0][0]))
-
-        dump_merged_dataset(global_dataset, out_path)
-        print("Ok...")
-
-
-def dump_merged_dataset(data, out_path):
-    with open(out_path, 'w') as json_file:
-        json_file.write('[\n')
-        for row_idx, row in enumerate(data):
-            json_file.write('  [\n')
-            for vector_idx, vector in enumerate(row):
-                vector_str = '    ' + json.dumps(vector)
-                if vector_idx < len(row) - 1:
-                    json_file.write(f'{vector_str},\n')
-                else:
-                    json_file.write(f'{vector_str}\n')
-            if row_idx < len(data) - 1:
-                json_file.write('  ],\n')
-            else:
-                json_file.write('  ]\n')
-        json_file.write(']\n')
+    out_path = "~/Fall_detection_dataset/Dataset Tools/out/final_merged_dataset.json" # use a .md4fd path for the binary format, .shards for shards
+    staging_directory = "~/Fall_detection_dataset/Dataset Tools/out/merge_staging" # None for a full merge every time
+    chunk_size = 10000 # samples shuffled in memory at a time
+    seed = 0
+
+    input_directory = os.path.expanduser(input_directory)
+    out_path = os.path.expanduser(out_path)
+
+    # Schema sidecars of the JSON datasets are not datasets
+    in_paths = [os.path.join(input_directory, file) for file in sorted(os.listdir(input_directory)) if not file.endswith(SCHEMA_SUFFIX)]
+    if staging_directory is None:
+        tot_samples = merge_datasets(in_paths, out_path, chunk_size, seed)
+    else:
+        tot_samples = merge_incremental(in_paths, out_path, staging_directory, seed)
+
+    print(f"Merged {tot_samples} samples into {out_path}")
+    print("Ok...")
+
+
+def repair_bar(features, previous_bar):
+    '''
+    Adjust the body aspect ratio of a sample in place: a missing value takes the previous one, a value over 40
+    is divided by 10 (suppose a 10 px body width)
+    previous_bar carries the last value across consecutive samples of the same file, the updated one is returned
+    '''
+    bar = features[:, BAR_INDEX]
+    if len(bar) == 0:
+        return previous_bar
+
+    bar[bar > 40] /= 10
+
+    # Forward fill the missing values, starting from previous_bar
+    valid = ~np.isnan(bar)
+    last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(bar)), -1))
+    fill_value = np.nan if previous_bar is None else previous_bar
+    features[:, BAR_INDEX] = np.where(last_valid >= 0, bar[np.maximum(last_valid, 0)], fill_value)
+
+    last_bar = features[-1, BAR_INDEX]
+    return None if np.isnan(last_bar) else float(last_bar)
+
+
+def get_source_name(in_path):
+    return os.path.basename(os.path.normpath(in_path))
+
+
+def iter_tagged_samples(in_path):
+    # (features, label, source, subject) of every sample, the source being the input dataset
+    tags = load_tags(in_path)
+    subjects = tags[1] if tags is not None else None
+
+    for k, (features, label) in enumerate(iter_samples(in_path)):
+        yield features, label, get_source_name(in_path), subjects[k] if subjects is not None else None
+
+
+def write_chunk(chunk, chunk_path, rng):
+    permutation = rng.permutation(len(chunk))
+
+    with BinaryDatasetWriter(chunk_path) as writer:
+        writer.write_batch(np.stack([chunk[k][0] for k in permutation]), [chunk[k][1] for k in permutation],
+                           [chunk[k][2] for k in permutation], [chunk[k][3] for k in permutation])
+
+
+def merge_datasets(in_paths, out_path, chunk_size=10000, seed=0):
+    '''
+    Merge (BAR repair + external shuffle) the datasets in in_paths into out_path, return the number of samples
+    '''
+    schema = check_schemas([load_schema(in_path) for in_path in in_paths])
+    rng = np.random.default_rng(seed)
+    out_directory = os.path.dirname(os.path.abspath(out_path))
+
+    with tempfile.TemporaryDirectory(dir=out_directory) as tmp_directory:
+        chunk_paths = []
+        chunk = []
+
+        for file_path in in_paths:
+            print(f"Reading {file_path}")
+            previous_bar = None
+
+            for features, label, source, subject in iter_tagged_samples(file_path):
+                previous_bar = repair_bar(features, previous_bar)
+                chunk.append((features, label, source, subject))
+
+                if len(chunk) == chunk_size:
+                    chunk_paths.append(os.path.join(tmp_directory, f"chunk_{len(chunk_paths)}.md4fd"))
+                    write_chunk(chunk, chunk_paths[-1], rng)
+                    chunk = []
+
+        if chunk:
+            chunk_paths.append(os.path.join(tmp_directory, f"chunk_{len(chunk_paths)}.md4fd"))
+            write_chunk(chunk, chunk_paths[-1], rng)
+
+        return interleave_chunks(chunk_paths, out_path, rng, schema)
+
+
+def interleave_chunks(chunk_paths, out_path, rng, schema=None):
+    chunks = [load_dataset(chunk_path, mmap_mode='r') for chunk_path in chunk_paths]
+    tags = [load_tags(chunk_path) for chunk_path in chunk_paths]
+    counts = [len(labels) for features, labels in chunks]
+
+    order = np.repeat(np.arange(len(chunks), dtype=np.int32), counts)
+    rng.shuffle(order)
+    cursors = [0] * len(chunks)
+
+    with open_writer(out_path, schema) as writer:
+        for k in order:
+            features, labels = chunks[k]
+            sources, subjects = tags[k]
+            writer.write_sample(features[cursors[k]], labels[cursors[k]], sources[cursors[k]], subjects[cursors[k]])
+            cursors[k] += 1
+
+    return len(order)
+
+
+
+def load_manifest(staging_directory):
+    manifest_path = os.path.join(staging_directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {'version': MANIFEST_VERSION, 'sources': {}}
+
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'sources': {}}
+    return manifest
+
+
+def get_output_stamp(path):
+    '''
+    Total size and latest modification time (ns) of a dataset file or folder, None if it does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return {'size': os.path.getsize(path), 'mtime_ns': os.stat(path).st_mtime_ns}
+
+    size = 0
+    mtime_ns = os.stat(path).st_mtime_ns
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            stat = os.stat(os.path.join(root, file))
+            size += stat.st_size
+            mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+    return {'size': size, 'mtime_ns': mtime_ns}
+
+
+def save_manifest(manifest, staging_directory):
+    save_json(manifest, os.path.join(staging_directory, MANIFEST_FILE), indent=2)
+
+
+def stage_dataset(in_path, staged_path):
+    '''
+    Repair the BAR of every sample of in_path and write them to the binary dataset staged_path
+    Return the number of samples and the BAR min/max (None if the dataset has no BAR value)
+    '''
+    previous_bar = None
+    bar_min = float('inf')
+    bar_max = float('-inf')
+
+    with BinaryDatasetWriter(staged_path) as writer:
+        for features, label, source, subject in iter_tagged_samples(in_path):
+            previous_bar = repair_bar(features, previous_bar)
+            writer.write_sample(features, label, source, subject)
+
+            bar = features[:, BAR_INDEX]
+            if not np.isnan(bar).all():
+                bar_min = min(bar_min, float(np.nanmin(bar)))
+                bar_max = max(bar_max, float(np.nanmax(bar)))
+
+        samples = writer.samples
+
+    if bar_min > bar_max:
+        return samples, None, None
+    return samples, bar_min, bar_max
+
+
+def merge_incremental(in_paths, out_path, staging_directory, seed=0):
+    '''
+    Merge in_paths into out_path reading again only the inputs that changed since the last run
+    Return the number of samples
+    '''
+    out_path = os.path.expanduser(out_path) # recorded in the manifest, stamped and written with the same path
+    staging_directory = os.path.expanduser(staging_directory)
+    os.makedirs(staging_directory, exist_ok=True)
+
+    schema = check_schemas([load_schema(in_path) for in_path in in_paths])
+    manifest = load_manifest(staging_directory)
+    sources = {}
+    changed = False
+
+    for in_path in in_paths:
+        name = get_source_name(in_path)
+        staged_path = os.path.join(staging_directory, name + ".md4fd")
+        source_hash = hash_source(in_path)
+
+        entry = manifest['sources'].get(name)
+        if entry is not None and entry['hash'] == source_hash and os.path.exists(staged_path):
+            sources[name] = entry
+            continue
+
+        print(f"Staging {in_path}")
+        if os.path.exists(staged_path):
+            shutil.rmtree(staged_path)
+        samples, bar_min, bar_max = stage_dataset(in_path, staged_path)
+
+        sources[name] = {'path': in_path, 'hash': source_hash, 'staged_path': staged_path, 'samples': samples,
+                         'bar_min': bar_min, 'bar_max': bar_max}
+        changed = True
+
+    for name, entry in manifest['sources'].items():
+        if name not in sources:
+            print(f"Removing {entry['path']}")
+            if os.path.exists(entry['staged_path']):
+                shutil.rmtree(entry['staged_path'])
+            changed = True
+
+    offset = 0
+    for entry in sources.values():
+        entry['offset'] = offset
+        offset += entry['samples']
+
+    output = {'path': os.path.abspath(out_path), 'seed': seed, 'samples': offset}
+    stored = manifest.get('output', {})
+    if not changed and {key: stored.get(key) for key in output} == output and stored.get('stamp') == get_output_stamp(out_path):
+        print("No input changed, the merged dataset is up to date")
+        return offset
+
+    shuffle_staged([entry['staged_path'] for entry in sources.values()], out_path, seed, schema)
+    output['stamp'] = get_output_stamp(out_path)
+
+    manifest = {'version': MANIFEST_VERSION, 'sources': sources, 'output': output}
+    manifest['bar_min'] = min([entry['bar_min'] for entry in sources.values() if entry['bar_min'] is not None], default=None)
+    manifest['bar_max'] = max([entry['bar_max'] for entry in sources.values() if entry['bar_max'] is not None], default=None)
+    save_manifest(manifest, staging_directory)
+
+    return offset
+
+
+def shuffle_staged(staged_paths, out_path, seed=0, schema=None):
+    '''
+    Write the samples of the staged binary datasets to out_path following a seeded random permutation
+    The staged datasets are memory-mapped, only the permutation is held in memory
+    '''
+    staged = [load_dataset(staged_path, mmap_mode='r') for staged_path in staged_paths]
+    tags = [load_tags(staged_path) for staged_path in staged_paths]
+    offsets = np.cumsum([0] + [len(labels) for features, labels in staged])
+
+    permutation = np.random.default_rng(seed).permutation(offsets[-1])
+    with open_writer(out_path, schema) as writer:
+        for idx in permutation:
+            k = np.searchsorted(offsets, idx, side='right') - 1
+            features, labels = staged[k]
+            sources, subjects = tags[k]
+            writer.write_sample(features[idx - offsets[k]], labels[idx - offsets[k]], sources[idx - offsets[k]], subjects[idx - offsets[k]])
 
 
 
@@ -1,46 +1,88 @@
+import os
 import json
 import numpy as np
 
+from dataset_io import save_dataset, open_writer, load_tags, BAR_INDEX
+from dataset_loader import open_dataset
+from dataset_merger import get_output_stamp
+from landmark_features import KEYPOINT_NAMES
+
+'''
+BAR normalization of the merged dataset
+All the operations work on (samples, frames, 23) arrays, the dataset is processed in batches of batch_size samples
+so that memory stays bounded even for memory-mapped datasets larger than RAM
+With a .shards out_path the normalized dataset is written as shards in parallel, keeping the sample tags
+'''
+
+
+def bar_min_max(features):
+    # Missing BAR values (NaN) are ignored
+    bar = features[:, :, BAR_INDEX]
+    if bar.size == 0 or np.isnan(bar).all():
+        return float('inf'), float('-inf')
+
+    return float(np.nanmin(bar)), float(np.nanmax(bar))
+
+
+def normalize_bar(features, min_bar, max_bar):
+    features[:, :, BAR_INDEX] = (features[:, :, BAR_INDEX] - min_bar) / (max_bar - min_bar)
+    return features
+
+
+def out_of_range(features):
+    '''
+    Return the first value outside [0, 1], None if every value is in range
+    '''
+    bad = (features < 0) | (features > 1)
+    if bad.any():
+        return float(features[bad][0])
+    return None
 
 
 
 class DatasetNormalizer:
     def __init__(self):
-        self.in_path = "~/Fall_detection_dataset/Dataset Tools/out/final_merged_dataset.json"
-        self.out_path = "~/Fall_detection_dataset/Dataset Tools/out/final_normalized_dataset.json"
+        self.in_path = os.path.expanduser("~/Fall_detection_dataset/Dataset Tools/out/final_merged_dataset.json")
+        self.out_path = os.path.expanduser("~/Fall_detection_dataset/Dataset Tools/out/final_normalized_dataset.json") # or .md4fd / .shards
+        self.batch_size = 4096
+        # Manifest of an incremental merge (dataset_merger.merge_incremental), gives the BAR min/max without a scan
+        self.manifest_path = "~/Fall_detection_dataset/Dataset Tools/out/merge_staging/manifest.json"
 
     def normalize(self):
-        with open(self.in_path, 'r') as json_file:
-            data = json.load(json_file)
+        # Samples are read lazily (memory-mapped for .md4fd and .shards inputs) and written one batch at a time
+        dataset = open_dataset(self.in_path)
+        sources, subjects = load_tags(self.in_path) or ([None] * len(dataset), [None] * len(dataset))
 
-        min_bar, max_bar = self.extract_min_max(data)
+        min_bar, max_bar = self.load_min_max()
+        if min_bar is None:
+            min_bar, max_bar = self.extract_min_max(dataset)
         print(min_bar)
         print(max_bar)
-        
-        for row in data:
-            for vector in row[:-1]:  # Again, exclude the label if present
-                value = vector[22]
-                normalized_value = (value - min_bar) / (max_bar - min_bar)
-                vector[22] = normalized_value
 
-        self.dump_dataset(data)
+        # Batches are read in canonical keypoint order, the BAR range is recorded so the output can be denormalized
+        schema = None
+        if dataset.schema is not None:
+            schema = dict(dataset.schema, keypoints=list(KEYPOINT_NAMES), bar_range=[min_bar, max_bar])
+        
+        with open_writer(self.out_path, schema) as writer:
+            for start, (features, labels) in zip(range(0, len(dataset), self.batch_size), dataset.iter_batches(self.batch_size)):
+                stop = start + len(labels)
+                writer.write_batch(normalize_bar(features, min_bar, max_bar), labels, sources[start:stop], subjects[start:stop])
 
     
 
     def check_normalized_dataset(self):
-        with open(self.out_path, 'r') as json_file:
-            data = json.load(json_file)
+        dataset = open_dataset(self.out_path)
 
-        print(len(data))
-        print(len(data[0]))
-        print(len(data[0][0]))
+        print(len(dataset))
+        print(dataset.frames)
+        print(dataset.feature_size)
 
-        for row in data:
-            for vector in row[:-1]:
-                for el in vector:
-                    if (el < 0) or (el > 1):
-                        print(el)
-                        return False
+        for features, labels in dataset.iter_batches(self.batch_size):
+            el = out_of_range(features)
+            if el is not None:
+                print(el)
+                return False
 
         return True
 
@@ -48,35 +90,35 @@ class DatasetNormalizer:
 
 
     def dump_dataset(self, data):
-        with open(self.out_path, 'w') as json_file:
-            json_file.write('[\n')
-            for row_idx, row in enumerate(data):
-                json_file.write('  [\n')
-                for vector_idx, vector in enumerate(row):
-                    vector_str = '    ' + json.dumps(vector)
-                    if vector_idx < len(row) - 1:
-                        json_file.write(f'{vector_str},\n')
-                    else:
-                        json_file.write(f'{vector_str}\n')
-                if row_idx < len(data) - 1:
-                    json_file.write('  ],\n')
-                else:
-                    json_file.write('  ]\n')
-            json_file.write(']\n')
+        save_dataset(data, self.out_path)
         
 
         
-    def extract_min_max(self, data):
+    def load_min_max(self):
+        '''
+        BAR min/max recorded by the merger manifest, (None, None) if there is no manifest for the input dataset or
+        the input was written again since (stamp mismatch)
+        '''
+        if self.manifest_path is None or not os.path.exists(os.path.expanduser(self.manifest_path)):
+            return None, None
+
+        with open(os.path.expanduser(self.manifest_path), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        output = manifest.get('output', {})
+        if output.get('path') != os.path.abspath(self.in_path) or output.get('stamp') != get_output_stamp(self.in_path):
+            return None, None
+        return manifest['bar_min'], manifest['bar_max']
+
+
+    def extract_min_max(self, dataset):
         min_value = float('inf')
         max_value = float('-inf')
 
-        for row in data:
-            for vector in row[:-1]:  # Exclude the last element if it's the label
-                bar = vector[22]  # 23rd element (0-indexed, so it's index 22)
-                if bar < min_value:
-                    min_value = bar
-                if bar > max_value:
-                    max_value = bar
+        for features, labels in dataset.iter_batches(self.batch_size):
+            batch_min, batch_max = bar_min_max(features)
+            min_value = min(min_value, batch_min)
+            max_value = max(max_value, batch_max)
         
         return min_value, max_value
 
@@ -86,4 +128,4 @@ if __name__ == "__main__":
     dataset_normalizer = DatasetNormalizer()
     # dataset_normalizer.normalize()
     print(dataset_normalizer.check_normalized_dataset())
-        
\ No newline at end of file
+        
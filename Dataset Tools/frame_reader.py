@@ -0,0 +1,209 @@
+import os
+import cv2
+import math
+import time
+import threading
+from fractions import Fraction
+from collections import OrderedDict
+
+'''
+Frame access for image folders (UR-Fall, FALL-UP) and video files (Le2i, High quality fall simulation)
+iter_sampled_frames is the decode stage of the landmark extraction (frame rate resampling and downscaling),
+FrameReader gives random access by frame index while keeping at most buffer_size decoded frames in memory, so the
+review display no longer needs every frame of a recording in RAM.
+CameraCapture reads a live camera in a background thread for the real-time capture of DatasetCreator.
+'''
+
+
+def get_source_fps(source, default_fps):
+    '''
+    Frame rate of a video file as stored in its container, default_fps for image folders (and unreadable videos)
+    '''
+    if os.path.isdir(source):
+        return default_fps
+
+    video_cap = cv2.VideoCapture(source)
+    fps = video_cap.get(cv2.CAP_PROP_FPS)
+    video_cap.release()
+
+    return fps if fps > 0 else default_fps
+
+
+def resize_frame(image, max_side):
+    scale = max_side / max(image.shape[0], image.shape[1])
+    if scale >= 1:
+        return image
+
+    return cv2.resize(image, (round(image.shape[1]*scale), round(image.shape[0]*scale)), interpolation=cv2.INTER_AREA)
+
+
+def iter_sampled_frames(source, source_fps=30, target_fps=None, max_side=None):
+    '''
+    Yield (frame index, frame, repeats) resampled to target_fps and downscaled so that no side exceeds max_side
+    source_fps is only used for image folders, videos use the frame rate of their container.
+    repeats is the number of target frames the source frame stands for: frames with no target frame are dropped
+    (dropped video frames are grabbed but not decoded, dropped images are not read at all) and, when the source is
+    slower than target_fps, frames are repeated instead of being decoded twice.
+    target_fps / max_side = None keep the source frame rate / resolution
+    '''
+    if target_fps is None:
+        ratio = Fraction(1)
+    else:
+        ratio = Fraction(target_fps).limit_denominator(1000) / Fraction(get_source_fps(source, source_fps)).limit_denominator(1000)
+
+    def repeats(idx):
+        # Number of target frame times falling in the time span of source frame idx
+        return math.ceil((idx + 1) * ratio) - math.ceil(idx * ratio)
+
+    if os.path.isdir(source):
+        for idx, image in enumerate(sorted(os.listdir(source))):
+            count = repeats(idx)
+            if count > 0:
+                image = cv2.imread(os.path.join(source, image))
+                yield idx, image if max_side is None else resize_frame(image, max_side), count
+    else:
+        video_cap = cv2.VideoCapture(source)
+        idx = 0
+
+        while video_cap.grab():
+            count = repeats(idx)
+            if count > 0:
+                ret, image = video_cap.retrieve()
+                if not ret:
+                    break
+                yield idx, image if max_side is None else resize_frame(image, max_side), count
+            idx += 1
+        video_cap.release()
+
+
+
+class FrameReader():
+    def __init__(self, source, buffer_size):
+        self.source = source
+        self.buffer_size = buffer_size
+        self.buffer = OrderedDict()     # frame index -> frame, oldest first
+
+        if os.path.isdir(source):
+            self.image_paths = [os.path.join(source, image) for image in sorted(os.listdir(source))]
+            self.video_cap = None
+        else:
+            self.image_paths = None
+            self.video_cap = cv2.VideoCapture(source)
+            self.next_idx = 0           # index of the frame the next video_cap.read() returns
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def read(self, idx):
+        '''
+        Return a copy of frame idx (drawing on it does not alter the buffer), None if the frame does not exist
+        Frames are decoded on demand, reading forward is sequential and going back to an evicted frame seeks the video.
+        Only requested frames are buffered, video frames skipped on the way are grabbed without being decoded
+        '''
+        if idx not in self.buffer:
+            if self.video_cap is None:
+                if idx >= len(self.image_paths):
+                    return None
+                self.push(idx, cv2.imread(self.image_paths[idx]))
+            else:
+                if idx < self.next_idx:
+                    self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+                    self.next_idx = idx
+
+                while self.next_idx < idx:
+                    if not self.video_cap.grab():
+                        return None
+                    self.next_idx += 1
+
+                ret, image = self.video_cap.read()
+                if not ret:
+                    return None
+                self.push(idx, image)
+                self.next_idx += 1
+
+        return self.buffer[idx].copy()
+
+
+    def push(self, idx, image):
+        self.buffer[idx] = image
+        if len(self.buffer) > self.buffer_size:
+            self.buffer.popitem(last=False)
+
+
+    def close(self):
+        self.buffer.clear()
+        if self.video_cap is not None:
+            self.video_cap.release()
+
+
+
+class CameraCapture():
+    '''
+    Live camera reader running in a background thread with a latest-frame policy
+    The thread grabs frames at the camera rate and only keeps the newest one, stamped with its capture time: a consumer
+    slower than the camera skips (drops) frames instead of lagging further and further behind the camera
+    '''
+    def __init__(self, camera_channel):
+        self.camera_channel = camera_channel
+        self.condition = threading.Condition()
+
+        self.frame = None
+        self.timestamp = None
+        self.captured = 0   # frames captured so far
+        self.returned = 0   # number of the last frame returned by read()
+        self.dropped = 0    # frames replaced by a newer one before being read
+        self.running = True
+
+        self.thread = threading.Thread(target=self.capture, daemon=True)
+        self.thread.start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def capture(self):
+        while self.running:
+            ret, frame = self.camera_channel.read()
+            timestamp = time.monotonic()
+
+            with self.condition:
+                if not ret:
+                    self.running = False
+                elif self.captured > self.returned:
+                    self.dropped += 1
+
+                if ret:
+                    self.frame = frame
+                    self.timestamp = timestamp
+                    self.captured += 1
+                self.condition.notify_all()
+
+
+    def read(self):
+        '''
+        Wait for a frame newer than the last one read, return (capture time in seconds, frame)
+        (None, None) once the camera stopped and every frame was read
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.captured > self.returned or not self.running)
+            if self.captured == self.returned:
+                return None, None
+
+            self.returned = self.captured
+            return self.timestamp, self.frame
+
+
+    def close(self):
+        self.running = False
+        self.thread.join()
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+from dataset_io import save_json
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+'''
+Per-stage timing instrumentation
+A StageTimer accumulates the wall time and number of calls of named stages (decode, inference, bar, windowing,
+serialization, ...). Stages may be timed from several threads, stages running in parallel threads overlap, so their
+times do not add up to the elapsed time.
+Reports are plain JSON, see processing_pipeline.run_pipeline for the layout.
+'''
+
+STATM_PATH = "/proc/self/statm"
+RSS_SAMPLE_INTERVAL = 0.01 # seconds
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of the current process in MB, None where it cannot be measured
+    '''
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024) # bytes on macOS
+    return peak / 1024 # kilobytes on Linux
+
+
+def current_rss_mb():
+    '''
+    Resident set size of the current process in MB, None where it cannot be measured (Linux only)
+    '''
+    try:
+        with open(STATM_PATH) as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+
+class RSSSampler():
+    '''
+    Peak resident set size in MB of the current process while the sampler is entered, sampled by a background thread
+    every interval seconds. Unlike peak_rss_mb, peaks reached before (e.g. by an earlier source of the same worker)
+    are not counted, peaks shorter than interval may be missed. peak is None where the RSS cannot be measured
+    '''
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = None
+        self.stop = threading.Event()
+        self.thread = None
+
+
+    def __enter__(self):
+        self.peak = current_rss_mb()
+        if self.peak is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+
+    def __exit__(self, *args):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.sample()
+
+
+    def sample(self):
+        rss = current_rss_mb()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.sample()
+
+
+
+class StageTimer():
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += calls
+
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+    def timed_iter(self, name, iterable):
+        '''
+        Yield the items of iterable, timing the production of each one as the stage name
+        '''
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.add(name, time.perf_counter() - start)
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+
+    def summary(self):
+        with self.lock:
+            return {name: {'seconds': stage['seconds'], 'calls': stage['calls'], 'ms_per_call': 1000 * stage['seconds'] / stage['calls']}
+                    for name, stage in self.stages.items()}
+
+
+
+def timed(timer, name):
+    # Time a block as the stage name, or do nothing when there is no timer
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
+
+
+def save_report(report, report_path):
+    save_json(report, os.path.expanduser(report_path), indent=2)
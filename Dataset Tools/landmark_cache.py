@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+'''
+Persistent cache of per-source landmark extraction results
+Every video file / image folder is stored in its own .npz file, named after a digest of the source path, the hash of
+the source content and the extractor settings. Re-annotating or re-windowing a source with a different
+sequence_length / overlap then only needs the cached feature vectors, MediaPipe is not run again.
+
+Each entry holds:
+    features: (frames, 23) float64 feature vectors, a missing BAR is stored as NaN
+    frame_idx: index of each feature vector in the source frames
+    detected: True where landmarks come from a detection, False where previous landmarks were reused
+    keys: landmark names in the feature vector order
+'''
+
+CACHE_VERSION = 1
+
+
+def hash_source(source):
+    '''
+    Content hash of a file, or of every file (relative path and content) below a folder, e.g. an image folder or
+    a .shards dataset
+    '''
+    sha = hashlib.sha1()
+
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            paths += [os.path.join(root, name) for name in files]
+        names = [os.path.relpath(path, source).replace(os.sep, '/') for path in paths]
+        names, paths = zip(*sorted(zip(names, paths))) if paths else ((), ())
+    else:
+        names, paths = [os.path.basename(source)], [source]
+
+    for name, path in zip(names, paths):
+        sha.update(name.encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+
+class LandmarkCache():
+    def __init__(self, cache_dir, settings):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.settings = settings
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def get_path(self, source):
+        # Hashes the whole source, callers that both load and save an entry should compute it once and pass it on
+        key = {'version': CACHE_VERSION, 'source': os.path.abspath(source), 'hash': hash_source(source), 'settings': self.settings}
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+        return os.path.join(self.cache_dir, f"{digest}.npz")
+
+
+    def load(self, source, path=None):
+        '''
+        Return the cached extraction result of a source (same layout as extract_source) or None on a cache miss
+        path is the entry path of the source (see get_path), computed when not given
+        '''
+        if path is None:
+            path = self.get_path(source)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as entry:
+            features = entry['features']
+            frame_idx = entry['frame_idx'].tolist()
+            detected = entry['detected'].tolist()
+            keys = entry['keys'].tolist()
+
+        return {'source': source, 'queue': features, 'keys': keys, 'frame_idx': frame_idx, 'detected': detected}
+
+
+    def save(self, result, path=None):
+        if path is None:
+            path = self.get_path(result['source'])
+
+        keys = result['keys']
+        features = np.asarray(result['queue'], dtype=np.float64).reshape(len(result['queue']), 23)
+
+        # Write to a temporary file first so that an interrupted run never leaves a truncated entry
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, features=features, frame_idx=np.array(result['frame_idx'], dtype=np.int64),
+                     detected=np.array(result['detected'], dtype=bool), keys=np.array(keys))
+        os.replace(tmp_path, path)
@@ -2,14 +2,99 @@ import cv2
 import numpy as np
 import mediapipe as mp
 
+from instrumentation import timed
+from landmark_features import KEYPOINT_NAMES, de_normalize_landmarks, draw_selected_landmarks
+
+EXTRACTOR_VERSION = 1  # recorded in the dataset schemas, bump when the extracted landmarks or BAR change
+
+POSE_KEYPOINTS = [0, 11, 12, 23, 24, 25, 26, 28, 27]   # pose landmark of the first 9 keypoints of KEYPOINT_NAMES
+POSE_LEFT_WRIST = 15
+POSE_RIGHT_WRIST = 16
+LEFT_SHOULDER, RIGHT_SHOULDER, LEFT_KNEE, RIGHT_KNEE = 1, 2, 5, 6
+MIN_DETECTION_CONFIDENCE = 0.70
+MIN_TRACKING_CONFIDENCE = 0.80
+MOTION_THRESHOLD = 3.0     # mean absolute gray level change of the pose region, out of 255
+
+
+def get_extractor_settings(model='holistic', model_complexity=1, tracking=False, redetect_interval=10, smoothing=0.5,
+                           min_detection_confidence=MIN_DETECTION_CONFIDENCE, min_tracking_confidence=MIN_TRACKING_CONFIDENCE,
+                           motion_threshold=MOTION_THRESHOLD):
+    '''
+    Settings that change the extracted landmarks of a LandmarkExtractor built with these parameters (e.g. the
+    landmark_extractor_params of a config), used to key cached extraction results and recorded in the dataset schemas
+    No model is loaded, see LandmarkExtractor.get_settings for an existing extractor
+    '''
+    settings = {'model': model, 'model_complexity': model_complexity, 'min_detection_confidence': min_detection_confidence}
+    if tracking:
+        settings.update({'tracking': True, 'redetect_interval': redetect_interval, 'smoothing': smoothing,
+                         'min_tracking_confidence': min_tracking_confidence, 'motion_threshold': motion_threshold})
+    return settings
+
+
+def get_schema_extractor(settings, max_side):
+    # extractor entry of a dataset schema, max_side is the size frames were downscaled to (None for native frames)
+    return dict(settings, version=EXTRACTOR_VERSION, max_side=max_side)
+
+
+
 class LandmarkExtractor():
-    def __init__(self):
+    def __init__(self, model='holistic', model_complexity=1, tracking=False, redetect_interval=10, smoothing=0.5):
+        '''
+        model = 'holistic' runs face, hands and pose models and takes the wrists from the hand landmarks,
+        model = 'pose' only runs the (much cheaper) pose model and takes the wrists from the pose landmarks.
+        model_complexity selects the pose landmark model: 0 lite, 1 full, 2 heavy.
+        Both models run in video mode: the person is tracked from the previous frame and the detector only runs when
+        tracking is lost, so frames of a recording must be fed in order.
+
+        tracking = True also skips the model on frames where the person did not move: the region of the previous
+        pose is compared with the same region of the last processed frame and, if it barely changed, the previous
+        landmarks are reused. The model runs again at least every redetect_interval frames and whenever the pose
+        confidence (mean visibility) drops under min_tracking_confidence. Landmarks are also smoothed across processed
+        frames (exponential moving average, smoothing = weight of the previous landmarks), which removes the jitter
+        of long static stretches.
+        '''
         self.frame = None
         self.image_size = None
+        self.timer = None # set a StageTimer to time inference and BAR computation
+        self.keypoints = np.zeros((len(KEYPOINT_NAMES), 2), dtype=np.float32)
+        self.pixels = np.zeros((len(KEYPOINT_NAMES), 2))
+
+        self.tracking = tracking
+        self.redetect_interval = redetect_interval
+        self.smoothing = smoothing
+        self.min_tracking_confidence = MIN_TRACKING_CONFIDENCE
+        self.motion_threshold = MOTION_THRESHOLD
+        self.reset_tracking()
 
         self.mp_drawing = mp.solutions.drawing_utils
         self.mp_holistic = mp.solutions.holistic
-        self.holistic = self.mp_holistic.Holistic(min_detection_confidence=0.70)
+        self.model = model
+        self.model_complexity = model_complexity
+        self.min_detection_confidence = MIN_DETECTION_CONFIDENCE
+
+        if model == 'holistic':
+            self.holistic = self.mp_holistic.Holistic(static_image_mode=False, model_complexity=model_complexity,
+                                                      min_detection_confidence=self.min_detection_confidence)
+        elif model == 'pose':
+            self.holistic = mp.solutions.pose.Pose(static_image_mode=False, model_complexity=model_complexity,
+                                                   min_detection_confidence=self.min_detection_confidence)
+        else:
+            raise ValueError(f"Unknown landmark model {model}, expected 'holistic' or 'pose'")
+
+
+    def get_settings(self):
+        # Settings that change the extracted landmarks, see get_extractor_settings
+        return get_extractor_settings(self.model, self.model_complexity, self.tracking, self.redetect_interval, self.smoothing,
+                                      self.min_detection_confidence, self.min_tracking_confidence, self.motion_threshold)
+
+
+    def reset_tracking(self):
+        # Call between recordings, so that a new recording never reuses the landmarks of the previous one
+        self.tracked_keypoints = None
+        self.tracked_bar = None
+        self.tracked_confidence = 0
+        self.tracked_roi = None
+        self.frames_since_detection = 0
 
 
     def draw_pose_landmarks(self, landmarks, image):
@@ -23,52 +108,144 @@ class LandmarkExtractor():
                                        self.mp_drawing.DrawingSpec(color=(180,100,100), thickness=2, circle_radius=2))
         
     def draw_selected_landmarks(self, landmarks, image):
-        for key in landmarks.keys():
-            cv2.circle(image, (landmarks[key][0], landmarks[key][1]), 4, (0, 0,255), thickness=-1)
-
-        return image
+        return draw_selected_landmarks(landmarks, image)
         
     
     def get_body_landmarks(self, image):
+        '''
+        Landmarks dict (KEYPOINT_NAMES order, [x, y] normalized by the image size) and BAR of the person in image,
+        (None, None) when nobody is detected. Built on get_body_keypoints, the extraction engine uses the array directly
+        '''
+        keypoints, body_aspect_ratio = self.get_body_keypoints(image)
+        if keypoints is None:
+            return None, None
+
+        return {key: [float(keypoints[k, 0]), float(keypoints[k, 1])] for k, key in enumerate(KEYPOINT_NAMES)}, body_aspect_ratio
+
+
+    def get_body_keypoints(self, image):
+        '''
+        Gather the 11 keypoints of KEYPOINT_NAMES by fixed landmark index into a preallocated float32 (11, 2) array and
+        compute the BAR from it. A missing hand gives a [0, 0] wrist (holistic model).
+        Return (keypoints, BAR), (None, None) when nobody is detected. keypoints is overwritten by the next call,
+        copy it to keep it. float32 holds the MediaPipe landmarks exactly, they are float32 values too
+        '''
         self.image_size = [image.shape[1], image.shape[0]]
+
+        if self.tracking:
+            with timed(self.timer, 'tracking'):
+                reuse = self.is_static(image)
+            if reuse:
+                self.frames_since_detection += 1
+                self.keypoints[:] = self.tracked_keypoints
+                return self.keypoints, self.tracked_bar
+
         self.frame = image
 
-        results = self.holistic.process(image)
+        with timed(self.timer, 'inference'):
+            results = self.holistic.process(image)
 
-        body_pose_landmarks = results.pose_landmarks
-        right_hand_landmarks = results.right_hand_landmarks
-        left_hand_landmarks = results.left_hand_landmarks
+        if results.pose_landmarks is None:
+            if self.tracking:
+                self.reset_tracking()
+            return None, None
 
-        normalized_landmarks = self.get_selected_body_landmarks(body_pose_landmarks)
+        keypoints = self.keypoints
+        pose_landmarks = results.pose_landmarks.landmark
+        for k, idx in enumerate(POSE_KEYPOINTS):
+            keypoints[k, 0] = pose_landmarks[idx].x
+            keypoints[k, 1] = pose_landmarks[idx].y
 
-        if normalized_landmarks is not None:
-            right_wrist = self.get_wrist_landmarks(right_hand_landmarks)
-            left_wrist = self.get_wrist_landmarks(left_hand_landmarks)
+        if self.tracking:
+            self.update_tracking(keypoints, pose_landmarks, image)
 
-            normalized_landmarks['left_wrist'] = left_wrist
-            normalized_landmarks['right_wrist'] = right_wrist
-            
-            img_landmarks = self.de_normalize_body_landmarks(normalized_landmarks)
-            vd, hd = self.get_body_aspect_ratio(img_landmarks)
+        if self.model == 'pose':
+            for k, idx in ((9, POSE_LEFT_WRIST), (10, POSE_RIGHT_WRIST)):
+                keypoints[k, 0] = pose_landmarks[idx].x
+                keypoints[k, 1] = pose_landmarks[idx].y
+        else:
+            for k, hand_landmarks in ((9, results.left_hand_landmarks), (10, results.right_hand_landmarks)):
+                if hand_landmarks is None:
+                    keypoints[k] = 0
+                else:
+                    keypoints[k, 0] = hand_landmarks.landmark[0].x
+                    keypoints[k, 1] = hand_landmarks.landmark[0].y
 
-            if hd == 0:
-                hd = 1
-                print(f"Adjusting BAR {vd}/{hd}")                      # assume pixel-wise body width
-            body_aspect_ratio = vd/hd       #TODO: to be normalized after dataset creation
+        with timed(self.timer, 'bar'):
+            # Pixel coordinates truncated as de_normalize_body_landmarks does, computed in float64
+            np.multiply(keypoints, self.image_size, out=self.pixels)
+            np.trunc(self.pixels, out=self.pixels)
+            vd, hd = self.get_keypoints_aspect_ratio(self.pixels)
 
-            # image_out = image.copy()
-            # image_out = self.draw_selected_landmarks(img_landmarks, image)
-            # image_out = self.check_body_aspect_ratio(vd, hd, img_landmarks)
-            # cv2.imshow('', image_out)
-            # cv2.waitKey(20)
+        if hd == 0:
+            hd = 1
+            print(f"Adjusting BAR {vd}/{hd}")                      # assume pixel-wise body width
+        body_aspect_ratio = vd/hd       #TODO: to be normalized after dataset creation
 
-            return normalized_landmarks, body_aspect_ratio
-        
+        if self.tracking:
+            self.tracked_keypoints = keypoints.copy()
+            self.tracked_bar = body_aspect_ratio
+
+        return keypoints, body_aspect_ratio
+
+
+    def get_keypoints_aspect_ratio(self, pixels):
+        # get_body_aspect_ratio on the pixel keypoints array
+        vertical_distance = max(abs(pixels[LEFT_SHOULDER, 1] - pixels[RIGHT_KNEE, 1]), abs(pixels[RIGHT_SHOULDER, 1] - pixels[LEFT_KNEE, 1]))
+        horizontal_distance = max(abs(pixels[LEFT_SHOULDER, 0] - pixels[RIGHT_KNEE, 0]), abs(pixels[RIGHT_SHOULDER, 0] - pixels[LEFT_KNEE, 0]))
+
+        return int(vertical_distance), int(horizontal_distance)
+
+
+    def gray_roi(self, image, roi):
+        x0, y0, x1, y1 = roi
+        return cv2.cvtColor(cv2.resize(image[y0:y1, x0:x1], (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+
+    def is_static(self, image):
+        '''
+        True when the previous landmarks can be reused: recent confident detection and no motion in the pose region
+        '''
+        if self.tracked_keypoints is None or self.tracked_roi is None:
+            return False
+        if self.frames_since_detection + 1 >= self.redetect_interval or self.tracked_confidence < self.min_tracking_confidence:
+            return False
+        if image.shape[:2] != self.tracked_image_shape:
+            return False
+
+        motion = cv2.absdiff(self.gray_roi(image, self.tracked_roi), self.tracked_gray).mean()
+        return motion < self.motion_threshold
+
+
+    def update_tracking(self, keypoints, pose_landmarks, image):
+        '''
+        Smooth the fresh body keypoints (wrists excluded) with the previous ones in place and keep the pose region of
+        the frame for the motion check
+        '''
+        self.frames_since_detection = 0
+        body = keypoints[:len(POSE_KEYPOINTS)]
+
+        if self.tracked_keypoints is not None:
+            body *= 1 - self.smoothing
+            body += self.smoothing * self.tracked_keypoints[:len(POSE_KEYPOINTS)]
+
+        self.tracked_confidence = np.mean([pose_landmarks[idx].visibility for idx in POSE_KEYPOINTS])
+
+        # Bounding box of the pose, enlarged by a quarter on every side
+        low = body.min(axis=0)
+        high = body.max(axis=0)
+        margin = (high - low) / 4
+        x0, y0 = (np.clip(low - margin, 0, 1) * self.image_size).astype(int)
+        x1, y1 = (np.clip(high + margin, 0, 1) * self.image_size).astype(int)
+
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            self.tracked_roi = None
         else:
-            return None, None
+            self.tracked_roi = (x0, y0, x1, y1)
+            self.tracked_gray = self.gray_roi(image, self.tracked_roi)
+            self.tracked_image_shape = image.shape[:2]
 
 
-            
     def check_body_landmarks(self, coords):
         for key in coords.keys():
             for landmark in coords[key]:
@@ -78,51 +255,12 @@ class LandmarkExtractor():
                     coords[key][1] = 0
 
 
-    def get_wrist_landmarks(self, hand_landmarks):
-        if hand_landmarks is not None:
-            for idx, landmark in enumerate(hand_landmarks.landmark):
-                if idx == 0:
-                    return[landmark.x, landmark.y]
-                
-        return [0, 0]
-
-
-    def get_selected_body_landmarks(self, body_landmarks):
-        coords = {'front_face':None, 'left_shoulder':None, 'right_shoulder':None, 'left_hip':None, 'right_hip':None, 'left_knee':None, 'right_knee':None, 'right_ankle':None, 'left_ankle':None}
-
-        if body_landmarks is not None:
-            for idx, landmark in enumerate(body_landmarks.landmark):
-                if idx == 0:
-                    coords['front_face'] = [landmark.x, landmark.y]
-                elif idx == 11:
-                    coords['left_shoulder'] = [landmark.x, landmark.y]
-                elif idx == 12:
-                    coords['right_shoulder'] = [landmark.x, landmark.y]
-                elif idx == 23:
-                    coords['left_hip'] = [landmark.x, landmark.y]
-                elif idx == 24:
-                    coords['right_hip'] = [landmark.x, landmark.y]
-                elif idx == 25:
-                    coords['left_knee'] = [landmark.x, landmark.y]
-                elif idx == 26:
-                    coords['right_knee'] = [landmark.x, landmark.y]
-                elif idx == 28:
-                    coords['right_ankle'] = [landmark.x, landmark.y]
-                elif idx == 27:
-                    coords['left_ankle'] = [landmark.x, landmark.y]
-
-            return coords
-        else: 
-            return None
-        
-    
-    def de_normalize_body_landmarks(self, coords):
-        img_coords = {'front_face':None, 'left_shoulder':None, 'right_shoulder':None, 'left_hip':None, 'right_hip':None, 'left_knee':None, 'right_knee':None, 'right_ankle':None, 'left_ankle':None}
-
-        for key in coords.keys():
-            img_coords[key] =  [int(coords[key][0]*self.image_size[0]), int(coords[key][1]*self.image_size[1])]
+    def de_normalize_body_landmarks(self, coords, image_size=None):
+        # image_size defaults to the size of the last processed frame, pass it when drawing frames processed elsewhere
+        if image_size is None:
+            image_size = self.image_size
 
-        return img_coords
+        return de_normalize_landmarks(coords, image_size)
     
 
     def get_body_aspect_ratio(self, normalized_landmarks):
@@ -0,0 +1,90 @@
+import cv2
+import random
+import numpy as np
+
+'''
+Per-frame landmark post-processing and windowing shared by the extraction engine and the dataset processors
+Landmarks are either dicts (name -> [x, y]) or, on the extraction hot path, (11, 2) keypoint arrays in KEYPOINT_NAMES
+order, which is also the order of the coordinates in a feature vector
+The drawing helpers need no landmark model, so window previews can be drawn by a process that runs none
+'''
+
+KEYPOINT_NAMES = ['front_face', 'left_shoulder', 'right_shoulder', 'left_hip', 'right_hip', 'left_knee', 'right_knee', 'right_ankle', 'left_ankle', 'left_wrist', 'right_wrist']
+LEFT_HIP, RIGHT_HIP, LEFT_WRIST, RIGHT_WRIST = 3, 4, 9, 10
+
+
+def devectorize_landmarks(feature_vector, keys):
+    '''
+    Rebuild the landmarks dict (in the given keys order) from a feature vector
+    '''
+    landmarks = {}
+    for k, key in enumerate(keys):
+        landmarks[key] = [feature_vector[2*k], feature_vector[2*k + 1]]
+
+    return landmarks
+    
+
+def fix_wrist_keypoints(keypoints):
+    '''
+    Hand landmark detector does not capture wrist landmarks, in this case the best thing is to assume person falling with
+    straight arms pointing the floor, so wrist landmarks can be similar to hip landmarks
+    A [0, 0] wrist of the keypoints array is moved next to the hip of the same side, in place
+    '''
+    rand_x = random.uniform(0.001, 0.01)
+    rand_y = random.uniform(0.001, 0.01)
+
+    for wrist, hip in ((LEFT_WRIST, LEFT_HIP), (RIGHT_WRIST, RIGHT_HIP)):
+        if keypoints[wrist, 0] == 0 and keypoints[wrist, 1] == 0:
+            keypoints[wrist, 0] = keypoints[hip, 0] + rand_x
+            keypoints[wrist, 1] = keypoints[hip, 1] + rand_y
+    return keypoints
+
+
+def check_body_keypoints(keypoints):
+    # A keypoint at [0, 0] is out of the image, return the name of the first one
+    missing = np.flatnonzero((keypoints == 0).all(axis=1))
+    if len(missing) > 0:
+        return False, KEYPOINT_NAMES[missing[0]]
+    return True, "None"
+
+
+def de_normalize_landmarks(coords, image_size):
+    # Normalized landmarks to pixel coordinates of an image of image_size [width, height]
+    img_coords = {'front_face':None, 'left_shoulder':None, 'right_shoulder':None, 'left_hip':None, 'right_hip':None, 'left_knee':None, 'right_knee':None, 'right_ankle':None, 'left_ankle':None}
+
+    for key in coords.keys():
+        img_coords[key] = [int(coords[key][0]*image_size[0]), int(coords[key][1]*image_size[1])]
+
+    return img_coords
+
+
+def draw_selected_landmarks(landmarks, image):
+    for key in landmarks.keys():
+        cv2.circle(image, (landmarks[key][0], landmarks[key][1]), 4, (0, 0,255), thickness=-1)
+
+    return image
+
+
+def stack_feature_vectors(queue, feature_size=23):
+    '''
+    Contiguous frames x feature_size float64 array of a queue of feature vectors, a missing BAR (None) becomes NaN
+    float64 keeps the values written to JSON datasets identical to the extracted ones
+    '''
+    if isinstance(queue, np.ndarray):
+        return queue
+    if len(queue) == 0:
+        return np.empty((0, feature_size))
+    return np.array(queue, dtype=np.float64)
+
+
+def sliding_windows(features, sequence_length, skip):
+    '''
+    Windows of sequence_length frames of a frames x 23 array, consecutive windows starting skip frames apart
+    Returned as a read-only windows x sequence_length x 23 strided view of features: no frame is copied, however
+    large the overlap, a window is only materialized when it is written
+    '''
+    if len(features) < sequence_length:
+        return np.empty((0, sequence_length) + features.shape[1:], dtype=features.dtype)
+
+    windows = np.lib.stride_tricks.sliding_window_view(features, sequence_length, axis=0)
+    return windows[::skip].transpose(0, 2, 1)
@@ -0,0 +1,165 @@
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from landmark_extractor import LandmarkExtractor
+from landmark_cache import LandmarkCache
+from frame_reader import iter_sampled_frames
+from async_stages import prefetch
+from instrumentation import StageTimer, RSSSampler
+from landmark_features import KEYPOINT_NAMES, fix_wrist_keypoints, check_body_keypoints
+from dataset_io import FEATURE_SIZE, BAR_INDEX
+
+'''
+Parallel landmark extraction engine
+A work unit (source) is either an image folder (UR-Fall, FALL-UP) or a video file (Le2i, High quality fall simulation).
+Each worker process owns its own LandmarkExtractor, hence its own MediaPipe Holistic instance, and processes whole
+sources so that the Holistic tracker always sees consecutive frames of the same recording.
+Results are returned in the same order as the sources were given.
+When a cache_dir is given, results are read from / written to a LandmarkCache so that MediaPipe only runs on sources
+that were never extracted with the current settings.
+decode_params (source_fps, target_fps, max_side) set the decode stage, see frame_reader.iter_sampled_frames
+Every result carries the extraction stats of its source: decoded frames, detection misses, frames/s, time per
+stage (decode, inference, bar) and peak RSS of the process that extracted it, sampled while extracting (or loading)
+this source only (instrumentation.RSSSampler, Linux only, None elsewhere)
+Workers are spawned, not forked: the calling process runs threads (writer, previews) that a fork would copy in an
+unknown state. The main script of the caller must be guarded by if __name__ == "__main__".
+'''
+
+DECODE_QUEUE_SIZE = 32  # decoded frames waiting for inference, bounds the memory of the decode stage
+
+_landmark_extractor = None
+_landmark_cache = None
+_decode_params = None
+
+
+def extract_source(landmark_extractor, source, decode_params):
+    '''
+    Run the landmark extractor over every frame of a source
+    Missing detections reuse the previous landmarks (with no BAR), frames before the first detection are dropped.
+    frame_idx maps every queue entry back to its frame in the source, detected flags the entries with fresh landmarks.
+    Entries follow the target_fps timebase of decode_params, a source frame may appear several times when upsampling
+    queue is an (entries, 23) float64 array (a missing BAR is NaN), keys the landmark names of its coordinates.
+    Keypoints are copied straight from the extractor array into a preallocated buffer, no dict or list per frame
+    '''
+    queue = np.empty((1024, FEATURE_SIZE))
+    n_entries = 0
+    feature_vector = np.empty(FEATURE_SIZE)                 # keypoints of the last detection + BAR of the current frame
+    body_keypoints = feature_vector[:BAR_INDEX].reshape(len(KEYPOINT_NAMES), 2)
+    has_landmarks = False
+    frame_idx = []
+    detected = []
+
+    landmark_extractor.reset_tracking()
+    timer = StageTimer()
+    landmark_extractor.timer = timer
+    start = time.perf_counter()
+    frames = 0
+    missed = 0
+
+    with RSSSampler() as rss:
+        # Frames are decoded by a background thread while the current one goes through MediaPipe
+        for idx, image, repeats in prefetch(timer.timed_iter('decode', iter_sampled_frames(source, **decode_params)), DECODE_QUEUE_SIZE):
+            frames += 1
+            keypoints, body_ar = landmark_extractor.get_body_keypoints(image)
+            if keypoints is not None:
+                body_keypoints[:] = keypoints
+                fix_wrist_keypoints(body_keypoints)
+
+                check, keys = check_body_keypoints(body_keypoints)
+                if not check:
+                    print(f"{keys} landmarks are out of image!")
+                feature_vector[BAR_INDEX] = body_ar
+                has_landmarks = True
+
+            else:
+                missed += 1
+                feature_vector[BAR_INDEX] = np.nan
+
+            if has_landmarks:
+                while n_entries + repeats > len(queue):
+                    queue = np.concatenate((queue, np.empty_like(queue)))
+                queue[n_entries:n_entries + repeats] = feature_vector
+                n_entries += repeats
+
+                frame_idx.extend([idx] * repeats)
+                detected.extend([keypoints is not None] * repeats)
+
+    landmark_extractor.timer = None
+    seconds = time.perf_counter() - start
+
+    stats = {'cached': False, 'frames': frames, 'missed': missed, 'miss_rate': missed / frames if frames else None,
+             'seconds': seconds, 'fps': frames / seconds if seconds > 0 else None, 'stages': timer.summary(),
+             'peak_rss_mb': rss.peak}
+    print(f"Extracted {source}: {frames} frames at {stats['fps'] or 0:.1f} fps, {missed} missed")
+
+    return {'source': source, 'queue': queue[:n_entries].copy(), 'keys': list(KEYPOINT_NAMES), 'frame_idx': frame_idx, 'detected': detected, 'stats': stats}
+
+
+def extract_cached_source(landmark_extractor, landmark_cache, source, decode_params):
+    if landmark_cache is None:
+        return extract_source(landmark_extractor, source, decode_params)
+
+    start = time.perf_counter()
+    path = landmark_cache.get_path(source) # the source is hashed once, for the lookup and the save of a miss
+    with RSSSampler() as rss:
+        result = landmark_cache.load(source, path)
+    if result is None:
+        result = extract_source(landmark_extractor, source, decode_params)
+        landmark_cache.save(result, path)
+    else:
+        print(f"Loaded cached landmarks of {source}")
+        result['stats'] = {'cached': True, 'seconds': time.perf_counter() - start, 'peak_rss_mb': rss.peak}
+
+    return result
+
+
+def create_cache(cache_dir, landmark_extractor, decode_params):
+    if cache_dir is None:
+        return None
+
+    # Resampling and resizing change the landmarks too, so they are part of the cache key
+    settings = dict(landmark_extractor.get_settings())
+    settings.update(decode_params)
+    return LandmarkCache(cache_dir, settings)
+
+
+def _init_worker(cache_dir, extractor_params, decode_params):
+    global _landmark_extractor, _landmark_cache, _decode_params
+    _landmark_extractor = LandmarkExtractor(**extractor_params)
+    _landmark_cache = create_cache(cache_dir, _landmark_extractor, decode_params)
+    _decode_params = decode_params
+
+
+def _extract_worker(source):
+    print(f"Extracting landmarks from {source}")
+    return extract_cached_source(_landmark_extractor, _landmark_cache, source, _decode_params)
+
+
+def extract_sources(sources, workers=None, cache_dir=None, extractor_params=None, decode_params=None):
+    '''
+    Generator over the extraction results of every source, in order
+    workers = None uses all the available cores, workers = 1 runs serially in the calling process
+    extractor_params are the LandmarkExtractor arguments (model, model_complexity)
+    Sources still pending are cancelled if the caller stops iterating
+    '''
+    if extractor_params is None:
+        extractor_params = {}
+    if decode_params is None:
+        decode_params = {}
+
+    if workers == 1:
+        landmark_extractor = LandmarkExtractor(**extractor_params)
+        landmark_cache = create_cache(cache_dir, landmark_extractor, decode_params)
+        for source in sources:
+            yield extract_cached_source(landmark_extractor, landmark_cache, source, decode_params)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(cache_dir, extractor_params, decode_params))
+    try:
+        for result in executor.map(_extract_worker, sources):
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
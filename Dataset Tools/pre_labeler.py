@@ -0,0 +1,82 @@
+import numpy as np
+
+from dataset_io import BAR_INDEX
+
+'''
+Automatic pre-labeling of the windows from the body dynamics
+A fall shows up in a window as three cues, each scored from 0 (no cue) to 1 (clear cue):
+ - BAR drop: the body aspect ratio goes from standing (> 1) to lying (< 1), scored by its relative drop
+ - hip velocity: the hips go down fast, scored by the peak downward velocity of the mid-hip (image heights per second)
+ - stillness: after the fastest hip drop the body barely moves, scored by the mean landmark speed afterwards
+The fall score is the weighted mean of the cues. Windows scoring over FALL_SCORE are labelled Fall, windows scoring
+under ADL_SCORE are labelled ADL, the others (and windows with too few detections) are left for manual review.
+'''
+
+HIP_Y = [7, 9]  # y of left_hip and right_hip in the feature vector
+
+BAR_DROP_FULL = 0.6         # relative BAR drop scored 1
+HIP_VELOCITY_FULL = 0.8     # peak downward hip velocity scored 1, image heights/s
+STILL_SPEED = 0.2           # mean landmark speed after the drop scored 0 (moving), image sizes/s
+WEIGHTS = (0.4, 0.4, 0.2)   # BAR drop, hip velocity, stillness
+
+FALL_SCORE = 0.7
+ADL_SCORE = 0.2
+MIN_DETECTED = 0.8          # fraction of frames with fresh landmarks needed to label a window
+
+
+def smooth(values, size):
+    # Moving average, keeps the length of values
+    if size <= 1:
+        return values
+    kernel = np.ones(size) / size
+    padded = np.pad(values, (size // 2, size - 1 - size // 2), mode='edge')
+    return np.convolve(padded, kernel, mode='valid')
+
+
+def score_window(window, fps):
+    '''
+    Fall score of a window (frames x 23 features, missing BAR as None or NaN) and the score of each cue
+    '''
+    window = np.asarray(window, dtype=np.float64)
+    smooth_size = max(1, int(fps / 10))
+
+    bar = window[:, BAR_INDEX]
+    valid = ~np.isnan(bar)
+    if valid.sum() < 2:
+        return None, None
+
+    bar = smooth(np.interp(np.arange(len(bar)), np.flatnonzero(valid), bar[valid]), smooth_size)
+    peak = int(np.argmax(bar))
+    bar_drop = (bar[peak] - bar[peak:].min()) / bar[peak] if bar[peak] > 0 else 0
+
+    hip_y = smooth(window[:, HIP_Y].mean(axis=1), smooth_size)
+    hip_velocity = np.diff(hip_y) * fps  # y grows downwards, a fall is a positive velocity
+    drop = int(np.argmax(hip_velocity))
+
+    coords = window[drop + 1:, :BAR_INDEX]
+    speed = np.abs(np.diff(coords, axis=0)).mean() * fps if len(coords) > 1 else 0
+
+    cues = (float(min(max(bar_drop, 0) / BAR_DROP_FULL, 1)),
+            float(min(max(hip_velocity[drop], 0) / HIP_VELOCITY_FULL, 1)),
+            float(max(1 - speed / STILL_SPEED, 0)))
+    score = float(np.dot(WEIGHTS, cues))
+
+    return score, cues
+
+
+def pre_label(window, detected, fps):
+    '''
+    Label of a window: 1 (Fall) or 0 (ADL) when the cues are clear, None when it needs a manual review
+    detected flags the frames of the window with fresh landmarks
+    '''
+    if np.mean(detected) < MIN_DETECTED:
+        return None
+
+    score, cues = score_window(window, fps)
+    if score is None:
+        return None
+    if score >= FALL_SCORE:
+        return 1
+    if score <= ADL_SCORE:
+        return 0
+    return None
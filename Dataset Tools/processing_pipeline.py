@@ -0,0 +1,275 @@
+import os
+import time
+import yaml
+
+from landmark_extractor import get_extractor_settings, get_schema_extractor
+from parallel_extractor import extract_sources
+from async_stages import AsyncWriter
+from annotation import LabelStore, iter_previews, play_window
+from pre_labeler import pre_label
+from landmark_features import KEYPOINT_NAMES, stack_feature_vectors, sliding_windows
+from instrumentation import StageTimer, peak_rss_mb, save_report
+from dataset_io import make_schema
+
+'''
+Config-driven processing pipeline shared by every dataset processor
+A processor only tells where its recordings are (dataset_path + source_layout in config.yaml) and how windows are
+labelled, every stage is shared:
+    source adapter -> decode + landmark extraction (parallel, cached) -> windowing -> review -> output
+Decoding, inference and output writing overlap: frames are decoded by a background thread of each extraction
+worker, the next recordings are extracted while the current one is reviewed, window previews are rendered by a
+background thread while the previous window is reviewed and accepted windows are written by a background thread.
+
+Source adapters turn a dataset folder into the list of sources (video files or image folders) to process:
+    image_folders   one image folder per recording (UR-Fall)
+    video_files     one video file per recording (Le2i, High quality fall simulation)
+    nested_trials   subject/activity/trial folders, every leaf folder is a recording (FALL-UP)
+
+Labelling: with a fixed label every window is confirmed with 'y', without it every window is labelled by typing
+0 (ADL) or 1 (Fall). Any other answer discards the window, 's' skips the rest of the recording.
+Every answer is saved to the labels_path sidecar file (see annotation.LabelStore), which is also the checkpoint of
+the run: only the windows with no label of the recordings not completed yet are shown, so an interrupted run
+resumes where it stopped (delete the labels file to start over). The mode config key selects:
+    interactive   review the windows and write the dataset, the accepted windows of a recording (stored ones included)
+                  are written once it is reviewed
+    annotate      review the windows, no dataset is written
+    materialize   write the dataset from the cached landmarks and the stored labels, nothing is shown
+Set cache_dir so that the recordings already reviewed are loaded from the landmark cache when resuming.
+With pre_label the windows with clear body dynamics are labelled automatically (see pre_labeler) and only the
+ambiguous ones are shown. With a fixed label, windows the pre-labeler confidently gives the other label are discarded.
+
+With report_path set, a JSON timing report is saved at the end of the run: total time, time per stage of the main
+process (windowing, review = time spent waiting for the annotator, serialization in the writer thread), peak RSS and
+the extraction stats of every source (frames, detection misses, frames/s, decode/inference/bar times, peak RSS).
+
+Written windows are tagged with their recording as source and, for the nested_trials layout, with their subject:
+the binary and sharded formats record the tags (see dataset_io).
+'''
+
+
+def load_config(file_path):
+    with open(file_path, 'r') as file:
+        try:
+            config = yaml.safe_load(file)
+            return config
+        except yaml.YAMLError as e:
+            print(f"Error loading YAML file: {e}")
+            return None
+
+
+def image_folder_sources(dataset_path):
+    return [os.path.join(dataset_path, folder) for folder in sorted(os.listdir(dataset_path))]
+
+
+def video_file_sources(dataset_path):
+    return [os.path.join(dataset_path, video_sequence) for video_sequence in sorted(os.listdir(dataset_path))]
+
+
+def nested_trial_sources(dataset_path):
+    sources = []
+    for root, dirs, files in os.walk(dataset_path):
+        dirs.sort()
+        if not dirs and files:
+            sources.append(root)
+
+    return sorted(sources)
+
+
+SOURCE_ADAPTERS = {'image_folders': image_folder_sources, 'video_files': video_file_sources, 'nested_trials': nested_trial_sources}
+
+
+def get_sequence_length(params):
+    # Sequences are cut on the target_fps timebase when resampling, on the nominal camera frame rate otherwise
+    fps = params['target_fps'] or params['cam_fps']
+    return int(fps * params['sequence_length'])
+
+
+def get_skip(params, sequence_length):
+    # Frames between the starts of consecutive windows, the overlap is in seconds so that it follows the frame rate
+    fps = params['target_fps'] or params['cam_fps']
+    skip = sequence_length - int(round(fps * params['overlap']))
+    if skip <= 0:
+        raise ValueError(f"overlap of {params['overlap']} s leaves no frame between windows of {params['sequence_length']} s, "
+                         f"it must be shorter than sequence_length")
+    return skip
+
+
+def get_decode_params(params):
+    return {'source_fps': params['cam_fps'], 'target_fps': params['target_fps'], 'max_side': params['max_side']}
+
+
+def get_schema(config_params, sequence_length):
+    params = config_params['dataset_processor_params']
+    extractor = get_schema_extractor(get_extractor_settings(**config_params['landmark_extractor_params']), params['max_side'])
+
+    return make_schema(KEYPOINT_NAMES, params['target_fps'] or params['cam_fps'], sequence_length, extractor)
+
+
+def iter_windows(n_frames, sequence_length, skip):
+    '''
+    Start index of every window of sequence_length frames, consecutive windows start skip frames apart
+    '''
+    return range(0, n_frames - sequence_length + 1, skip)
+
+
+def ask_label(label):
+    '''
+    Return the label of the window just shown, None to discard it, "s" to skip the rest of the recording
+    '''
+    ques = input("Save this sequence? \n")
+
+    if ques == "s":
+        return "s"
+    if label is not None:
+        return label if ques == "y" else None
+    if ques in ("0", "1"):
+        return int(ques)
+    return None
+
+
+def auto_label_windows(result, windows, starts, skip, fps, label, label_store):
+    '''
+    Label the windows of a source the pre-labeler is confident about, return the starts of the windows left for review
+    '''
+    sequence_length = windows.shape[1]
+
+    review = []
+    for i in starts:
+        answer = pre_label(windows[i // skip], result['detected'][i:i + sequence_length], fps)
+        if answer is None:
+            review.append(i)
+            continue
+
+        if label is not None and answer != label:
+            answer = None
+        label_store.set(result['source'], i, answer, auto=True, save=False)
+    label_store.save()
+
+    print(f"Pre-labeled {len(starts) - len(review)} windows, {len(review)} left for review")
+    return review
+
+
+def get_subject(source, dataset_path, source_layout):
+    # Only the nested_trials layout stores the recordings by subject (subject/activity/trial)
+    if source_layout != "nested_trials":
+        return None
+    return os.path.relpath(source, dataset_path).split(os.sep)[0]
+
+
+def write_labelled_windows(writer, label_store, source, windows, skip, subject=None):
+    for i, answer in label_store.items(source):
+        if answer is not None:
+            writer.write_sample(windows[i // skip], answer, source, subject)
+
+
+def review_windows(result, windows, label_store, params, label, timer):
+    '''
+    Show the windows of a source with no label yet and store the answers, then mark the source as completed
+    '''
+    source = result['source']
+    sequence_length = windows.shape[1]
+    skip = label_store.window_params['skip']
+
+    starts = [i for i in iter_windows(len(result['queue']), sequence_length, skip) if not label_store.has(source, i)]
+    if params['pre_label']:
+        starts = auto_label_windows(result, windows, starts, skip, params['target_fps'] or params['cam_fps'], label, label_store)
+
+    previews = iter_previews(result, starts, sequence_length, params['preview_max_side'])
+    for i, frames in previews:
+        print("New sequence...")
+        print(f"Going from {i} to {i+sequence_length}")
+
+        with timer.stage('review'):
+            play_window(frames)
+            answer = ask_label(label)
+        if answer == "s":
+            break
+
+        label_store.set(source, i, answer)
+        print("Saved..." if answer is not None else "Discarded")
+    previews.close()
+
+    label_store.mark_completed(source)
+
+
+def write_report(params, timer, results_stats, start, samples):
+    if params['report_path'] is None:
+        return
+
+    report = {'mode': params['mode'], 'seconds': time.perf_counter() - start, 'windows_written': samples,
+              'stages': timer.summary(), 'peak_rss_mb': peak_rss_mb(), 'sources': results_stats}
+    save_report(report, params['report_path'])
+    print(f"Timing report saved to {params['report_path']}")
+
+
+def run_pipeline(config_params, dataset_path, label=None):
+    '''
+    Process every recording of dataset_path in the configured mode
+    label is the fixed label of every window (confirmed with y), None to type the label of each window
+    '''
+    params = config_params['dataset_processor_params']
+    extractor_params = config_params['landmark_extractor_params']
+    start = time.perf_counter()
+    timer = StageTimer()
+
+    sequence_length = get_sequence_length(params)
+    skip = get_skip(params, sequence_length)
+
+    window_params = {'sequence_length': sequence_length, 'skip': skip, 'decode': get_decode_params(params)}
+    label_store = LabelStore(params['labels_path'], window_params)
+
+    if params['mode'] == "materialize":
+        materialize_dataset(config_params, dataset_path, label_store, timer, start)
+        return
+
+    sources = SOURCE_ADAPTERS[params['source_layout']](dataset_path)
+    writer = AsyncWriter(params['out_path'], timer=timer, schema=get_schema(config_params, sequence_length)) if params['mode'] == "interactive" else None
+    results_stats = []
+
+    completed = sum(label_store.is_completed(source) for source in sources)
+    if completed > 0:
+        print(f"Resuming: {completed} of {len(sources)} recordings already reviewed")
+
+    # Recordings are extracted in parallel and reviewed as soon as they are ready
+    for result in extract_sources(sources, params['workers'], params['cache_dir'], extractor_params, get_decode_params(params)):
+        print(f"Processing sequence {result['source']}")
+        results_stats.append(dict(source=result['source'], **result['stats']))
+
+        # Windows are strided views of the source frames, overlapping windows share their frames
+        with timer.stage('windowing'):
+            windows = sliding_windows(stack_feature_vectors(result['queue']), sequence_length, skip)
+
+        if not label_store.is_completed(result['source']):
+            review_windows(result, windows, label_store, params, label, timer)
+
+        if writer is not None:
+            write_labelled_windows(writer, label_store, result['source'], windows, skip, get_subject(result['source'], dataset_path, params['source_layout']))
+            print(f"Dataset has now {writer.samples} samples")
+
+    if writer is not None:
+        writer.close()
+    write_report(params, timer, results_stats, start, writer.samples if writer is not None else 0)
+
+
+def materialize_dataset(config_params, dataset_path, label_store, timer, start):
+    '''
+    Write every accepted window of the label store to out_path, reading the landmarks from the cache
+    '''
+    params = config_params['dataset_processor_params']
+    sequence_length = label_store.window_params['sequence_length']
+    skip = label_store.window_params['skip']
+
+    if params['cache_dir'] is None:
+        print("No cache_dir set, landmarks will be extracted again")
+
+    results_stats = []
+    with AsyncWriter(params['out_path'], timer=timer, schema=get_schema(config_params, sequence_length)) as writer:
+        for result in extract_sources(label_store.sources(), params['workers'], params['cache_dir'], config_params['landmark_extractor_params'], get_decode_params(params)):
+            results_stats.append(dict(source=result['source'], **result['stats']))
+
+            with timer.stage('windowing'):
+                windows = sliding_windows(stack_feature_vectors(result['queue']), sequence_length, skip)
+            write_labelled_windows(writer, label_store, result['source'], windows, skip, get_subject(result['source'], dataset_path, params['source_layout']))
+
+    print(f"Dataset has {writer.samples} samples")
+    write_report(params, timer, results_stats, start, writer.samples)